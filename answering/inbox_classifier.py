@@ -1,29 +1,32 @@
 from django.conf import settings
 
 from answering.models import Inbox
-from classifier.client import connect
+from classifier.client import get_cluster
 
 
 def train_inbox_classifier(inbox: Inbox):
     # TODO:
     tasks = inbox.tasks.all()
 
-    labels = []
-
-    samples = []
+    samples = {}
 
     for task in tasks:
         label = task.pk
 
         for sample in task.samples.all():
-            samples.append(f"{sample.subject}:\n\n{sample.content}")
-            labels.append(label)
+            samples[sample.pk] = (f"{sample.subject}:\n\n{sample.content}", label)
 
-    with connect(settings.API_HOST, settings.API_PORT, settings.API_SECRET) as client:
-        client.train_classifier(inbox.uuid.hex, samples, labels)
+    cluster = get_cluster(
+        settings.API_ENDPOINTS, settings.API_SECRET, settings.API_DERIVED_KEY
+    )
+    with cluster.connection(inbox.uuid.hex) as client:
+        client.update_classifier(inbox.uuid.hex, samples)
 
 
 def predict_inbox_task(inbox, subject, message):
     # TODO:
-    with connect(settings.API_HOST, settings.API_PORT, settings.API_SECRET) as client:
+    cluster = get_cluster(
+        settings.API_ENDPOINTS, settings.API_SECRET, settings.API_DERIVED_KEY
+    )
+    with cluster.connection(inbox.uuid.hex) as client:
         client.predict_class(inbox.uuid.hex, f"{subject}:\n\n{{messag}}")
@@ -17,7 +17,7 @@ from answering.models import (
     ProcessError,
     TaskTemplate,
 )
-from classifier.client import connect
+from classifier.client import get_cluster
 from context.vector_store import get_sentences, search_context
 
 
@@ -79,11 +79,10 @@ def create_output(input: InputMessage, task: TaskTemplate) -> OutputMessage:
 def classify_message(input: InputMessage) -> TaskTemplate:
     inbox = input.inbox
 
-    with connect(
-        settings.CLASSIFIER_HOST,
-        settings.CALSSIFIER_PORT,
-        settings.CLASSIFIER_SECRET,
-    ) as client:
+    cluster = get_cluster(
+        settings.API_ENDPOINTS, settings.API_SECRET, settings.API_DERIVED_KEY
+    )
+    with cluster.connection(inbox.name) as client:
         id = client.predict_class(inbox.name, [input.content])
     return inbox.tasks.get(pk=id)
 
@@ -152,16 +151,15 @@ def generate_text_openai(prompt, message, node: TaskTemplate) -> str:
 def train_classifier(inbox: Inbox):
     classes = inbox.tasks.all()
 
-    samples, labels = [], []
+    samples = {}
 
     for class_ in classes:
         for sample in class_.samples.all():
-            samples.append(sample.content)
-            labels.append(class_.pk)
-
-    with connect(
-        settings.CLASSIFIER_HOST,
-        settings.CALSSIFIER_PORT,
-        settings.CLASSIFIER_SECRET,
-    ) as client:
-        client.train_classifier(inbox.name, samples, labels, settings.CLASSIFIER_CONFIG)
+            samples[sample.pk] = (sample.content, class_.pk)
+
+    cluster = get_cluster(
+        settings.API_ENDPOINTS, settings.API_SECRET, settings.API_DERIVED_KEY
+    )
+    with cluster.connection(inbox.name) as client:
+        # Only samples added, changed or removed since the last training are sent.
+        client.update_classifier(inbox.name, samples)
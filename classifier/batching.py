@@ -0,0 +1,98 @@
+"""Micro-batching of encode requests on the server."""
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, List, Set, Tuple
+
+import numpy as np
+
+from classifier.metrics import METRICS, Histogram
+
+LOG = logging.getLogger("batching")
+
+BATCH_SIZE_BOUNDS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+
+
+class Batcher:
+    """Coalesces concurrent encode requests into batches.
+
+    Requests are collected for at most window seconds, or until max_size
+    documents are queued, then encoded in one call and split back up.
+    """
+
+    def __init__(
+        self,
+        encode: Callable[[List[str]], Awaitable[np.ndarray]],
+        window=0.005,
+        max_size=64,
+        sizes: Histogram | None = None,
+    ) -> None:
+        self.encode_batch = encode
+        self.window = window
+        self.max_size = max_size
+
+        # Documents, their future and when they were queued.
+        self.queue: List[Tuple[List[str], asyncio.Future, float]] = []
+        self.queued = 0
+        self.timer: asyncio.TimerHandle | None = None
+        self.running: Set[asyncio.Task] = set()
+
+        self.sizes = sizes or Histogram(BATCH_SIZE_BOUNDS)
+
+    async def encode(self, documents) -> np.ndarray:
+        """Encode the documents as part of the next batch."""
+        if isinstance(documents, str):
+            documents = [documents]
+        else:
+            documents = list(documents)
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        self.queue.append((documents, future, time.perf_counter()))
+        self.queued += len(documents)
+
+        if self.queued >= self.max_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.window, self.flush)
+
+        return await future
+
+    def flush(self) -> None:
+        """Start encoding the queued requests."""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        if not self.queue:
+            return
+
+        batch, self.queue, self.queued = self.queue, [], 0
+
+        task = asyncio.create_task(self._run(batch))
+        self.running.add(task)
+        task.add_done_callback(self.running.discard)
+
+    async def _run(self, batch: List[Tuple[List[str], asyncio.Future, float]]) -> None:
+        documents = [document for request, _, _ in batch for document in request]
+        self.sizes.observe(len(documents))
+
+        now = time.perf_counter()
+        for _, _, queued in batch:
+            METRICS.observe("phase_seconds", now - queued, phase="batch_wait")
+        LOG.debug("Encoding batch of %d documents", len(documents))
+
+        try:
+            embeddings = await self.encode_batch(documents)
+        except Exception as ex:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(ex)
+            return
+
+        offset = 0
+        for request, future, _ in batch:
+            if not future.done():
+                future.set_result(embeddings[offset : offset + len(request)])
+            offset += len(request)
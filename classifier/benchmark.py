@@ -0,0 +1,280 @@
+"""Micro-benchmarks of the wire protocols, from serialization to socket round trips."""
+import asyncio
+import platform
+import queue
+import socket
+import threading
+import timeit
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from functools import partial
+from io import BytesIO
+from typing import Callable, Dict, Iterable, List
+from uuid import uuid4
+
+import joblib
+import numpy as np
+
+from classifier.connection import (
+    INT_LENGTH,
+    NONCE_LENGTH,
+    PROTOCOL_FRAMES,
+    PROTOCOL_JOBLIB,
+    PROTOCOL_LOCAL,
+    PROTOCOL_SHARED_MEMORY,
+    Command,
+    Key,
+    Result,
+    gen_key,
+    pack_frame,
+    pack_obj,
+    receive_obj,
+    receive_obj_sync,
+    send_obj,
+    send_obj_sync,
+    unpack_obj,
+)
+
+# Protocols of the pack and unpack cases, shared memory needs a receiver and
+# is only part of the round trips.
+PACK_PROTOCOLS = (PROTOCOL_JOBLIB, PROTOCOL_FRAMES, PROTOCOL_LOCAL)
+ROUNDTRIP_PROTOCOLS = (*PACK_PROTOCOLS, PROTOCOL_SHARED_MEMORY)
+
+CASES = ("dump", "encrypt", "pack", "unpack", "roundtrip", "roundtrip_async")
+
+WORDS = (
+    "the inbox message answer request please thank you for your help we would "
+    "like to know more about the meeting next week our team can support this "
+    "project with data and time regards question order delivery invoice"
+).split()
+
+
+def _text(rng: np.random.Generator, words) -> str:
+    return " ".join(rng.choice(WORDS, words)).capitalize() + "."
+
+
+def payloads(seed=0) -> Dict[str, object]:
+    """Messages the way clients and the server send them, from tiny to large."""
+    rng = np.random.default_rng(seed)
+    samples = [" ".join(_text(rng, 15) for _ in range(8)) for _ in range(5000)]
+
+    return {
+        "short_string": Command("embedding", uuid4(), {"sentence": "Hello, can you help me?"}),
+        "sentences_1k": Command(
+            "embedding", uuid4(), {"sentence": [_text(rng, 12) for _ in range(1000)]}
+        ),
+        "embeddings_10k": Result(
+            rng.standard_normal((10_000, 384), dtype=np.float32), uuid4()
+        ),
+        "training_set": Command(
+            "train",
+            uuid4(),
+            {
+                "key": "inbox",
+                "ids": list(range(len(samples))),
+                "samples": samples,
+                "labels": rng.integers(0, 20, len(samples)).tolist(),
+            },
+        ),
+    }
+
+
+@dataclass
+class Measurement:
+    case: str
+    payload: str
+    protocol: int | None
+    bytes: int
+    seconds: float
+    runs: int
+
+    @property
+    def name(self) -> str:
+        return f"{self.case}/{self.payload}/{self.protocol or '-'}"
+
+    def as_dict(self) -> dict:
+        return {
+            "name": self.name,
+            **asdict(self),
+            "mb_per_s": self.bytes / self.seconds / 1e6 if self.seconds else 0.0,
+        }
+
+
+def measure(func: Callable, repeat=5) -> tuple:
+    """Seconds per call of func, the best of repeat runs of enough calls to take 0.2s."""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number, repeat * number
+
+
+def _dump(obj, compress=True) -> bytes:
+    """Serialized with joblib, like the payloads that are not raw arrays."""
+    with BytesIO() as io:
+        joblib.dump(obj, io, compress=compress)
+        return io.getvalue()
+
+
+def _wire(obj, key: Key, protocol) -> List:
+    """Buffers sent for obj, the size prefix first."""
+    if protocol >= PROTOCOL_LOCAL:
+        return pack_frame(obj, None)
+    if protocol >= PROTOCOL_FRAMES:
+        return pack_frame(obj, key)
+
+    size, data = pack_obj(obj, key)
+    return [size.to_bytes(INT_LENGTH, "big"), data]
+
+
+@contextmanager
+def _sync_pair(key: Key, protocol):
+    """Socket pair with a thread that sends the objects put into the queue."""
+    writer, reader = socket.socketpair()
+    objects: queue.Queue = queue.Queue()
+
+    def send():
+        while (obj := objects.get()) is not None:
+            send_obj_sync(writer, obj, key, protocol)
+
+    sender = threading.Thread(target=send, daemon=True)
+    sender.start()
+    try:
+        yield objects, reader
+    finally:
+        objects.put(None)
+        sender.join()
+        writer.close()
+        reader.close()
+
+
+def _roundtrip(objects: queue.Queue, reader: socket.socket, obj, key: Key, protocol):
+    """Let the sender of _sync_pair send obj and receive it."""
+    objects.put(obj)
+    shared_memory = protocol == PROTOCOL_SHARED_MEMORY
+    return receive_obj_sync(reader, key, protocol >= PROTOCOL_LOCAL, shared_memory)
+
+
+def _roundtrip_async(loop, writer, reader, obj, key: Key, protocol):
+    """Send obj and receive it concurrently on the loop."""
+    shared_memory = protocol == PROTOCOL_SHARED_MEMORY
+
+    async def roundtrip():
+        await asyncio.gather(
+            send_obj(writer, obj, key, protocol),
+            receive_obj(reader, key, protocol >= PROTOCOL_LOCAL, shared_memory),
+        )
+
+    loop.run_until_complete(roundtrip())
+
+
+def run(
+    cases: Iterable[str] = CASES,
+    names: Iterable[str] | None = None,
+    repeat=5,
+    secret="benchmark",
+) -> List[Measurement]:
+    """Measure the cases for the payloads, all payloads if names is None."""
+    key = gen_key(secret)
+    messages = payloads()
+    results = []
+    loop = asyncio.new_event_loop()
+
+    for name, obj in messages.items():
+        if names is not None and name not in names:
+            continue
+
+        dumped = _dump(obj)
+        nonce = bytes(NONCE_LENGTH)
+
+        for case in cases:
+            match case:
+                case "dump":
+                    for compress in (True, False):
+                        seconds, runs = measure(partial(_dump, obj, compress), repeat)
+                        size = len(_dump(obj, compress))
+                        label = "dump" if compress else "dump_raw"
+                        results.append(Measurement(label, name, None, size, seconds, runs))
+
+                case "encrypt":
+                    seconds, runs = measure(partial(key.encrypt, dumped), repeat)
+                    results.append(
+                        Measurement("encrypt_fernet", name, None, len(dumped), seconds, runs)
+                    )
+                    encrypt = partial(key.aead.encrypt, nonce, dumped, None)
+                    seconds, runs = measure(encrypt, repeat)
+                    results.append(
+                        Measurement("encrypt_aesgcm", name, None, len(dumped), seconds, runs)
+                    )
+
+                case "pack":
+                    for protocol in PACK_PROTOCOLS:
+                        size = sum(len(memoryview(b).cast("B")) for b in _wire(obj, key, protocol))
+                        seconds, runs = measure(partial(_wire, obj, key, protocol), repeat)
+                        results.append(Measurement(case, name, protocol, size, seconds, runs))
+
+                case "unpack":
+                    for protocol in PACK_PROTOCOLS:
+                        data = b"".join(bytes(b) for b in _wire(obj, key, protocol)[1:])
+                        local = protocol >= PROTOCOL_LOCAL
+                        seconds, runs = measure(partial(unpack_obj, data, key, local), repeat)
+                        results.append(Measurement(case, name, protocol, len(data), seconds, runs))
+
+                case "roundtrip":
+                    for protocol in ROUNDTRIP_PROTOCOLS:
+                        with _sync_pair(key, protocol) as (objects, reader):
+                            roundtrip = partial(_roundtrip, objects, reader, obj, key, protocol)
+                            seconds, runs = measure(roundtrip, repeat)
+                        results.append(
+                            Measurement(case, name, protocol, len(dumped), seconds, runs)
+                        )
+
+                case "roundtrip_async":
+                    for protocol in ROUNDTRIP_PROTOCOLS:
+                        reader, writer, reader_side = loop.run_until_complete(_async_pair())
+                        roundtrip = partial(
+                            _roundtrip_async, loop, writer, reader, obj, key, protocol
+                        )
+                        seconds, runs = measure(roundtrip, repeat)
+                        writer.close()
+                        reader_side.close()
+                        results.append(
+                            Measurement(case, name, protocol, len(dumped), seconds, runs)
+                        )
+
+    loop.close()
+    return results
+
+
+async def _async_pair():
+    """Stream reader and writer connected to each other."""
+    left, right = socket.socketpair()
+    reader, reader_side = await asyncio.open_connection(sock=left)
+    _, writer = await asyncio.open_connection(sock=right)
+    return reader, writer, reader_side
+
+
+def report(results: List[Measurement]) -> dict:
+    """Results as JSON, together with the environment they were measured in."""
+    return {
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+        },
+        "results": [result.as_dict() for result in results],
+    }
+
+
+def regressions(baseline: dict, current: dict, tolerance=0.2) -> List[dict]:
+    """Results that got slower than the baseline by more than the tolerance."""
+    before = {result["name"]: result for result in baseline["results"]}
+    slower = []
+
+    for result in current["results"]:
+        if result["name"] not in before:
+            continue
+        ratio = result["seconds"] / before[result["name"]]["seconds"]
+        if ratio > 1 + tolerance:
+            slower.append({"name": result["name"], "ratio": ratio})
+
+    return slower
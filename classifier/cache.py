@@ -0,0 +1,189 @@
+"""Embedding cache of the classifier server."""
+import hashlib
+import logging
+import mmap
+import struct
+from collections import OrderedDict
+from typing import Dict, Tuple
+
+import numpy as np
+
+LOG = logging.getLogger("cache")
+
+# key, dtype, size of the data in bytes
+RECORD_HEADER = struct.Struct(">16s8sI")
+
+
+def content_key(text: str, model="") -> bytes:
+    """Hash of the text and the name of its model used as cache key."""
+    digest = hashlib.blake2b(digest_size=16)
+    if model:
+        digest.update(model.encode() + b"\0")
+    digest.update(text.encode())
+    return digest.digest()
+
+
+class DiskSegment:
+    """Append only file of embeddings, read through a memory map.
+
+    The index is rebuilt by scanning the file on open, so the segment
+    survives restarts. When it grows beyond max_bytes it starts over.
+    """
+
+    def __init__(self, path, max_bytes) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.index: Dict[bytes, Tuple[int, np.dtype, int]] = {}
+        self.map: mmap.mmap | None = None
+
+        self.file = open(path, "a+b")
+        self._scan()
+
+    def __contains__(self, key: bytes) -> bool:
+        return key in self.index
+
+    @property
+    def size(self) -> int:
+        return self.file.tell()
+
+    def get(self, key: bytes) -> np.ndarray | None:
+        if key not in self.index:
+            return None
+
+        offset, dtype, nbytes = self.index[key]
+
+        if self.map is None or len(self.map) < offset + nbytes:
+            self._remap()
+        assert self.map is not None
+
+        return np.frombuffer(self.map, dtype, nbytes // dtype.itemsize, offset).copy()
+
+    def put(self, key: bytes, embedding: np.ndarray) -> None:
+        if key in self.index:
+            return
+
+        data = np.ascontiguousarray(embedding).tobytes()
+        record_size = RECORD_HEADER.size + len(data)
+
+        if self.size + record_size > self.max_bytes:
+            LOG.info("Disk segment %s is full, starting over", self.path)
+            self.clear()
+
+        header = RECORD_HEADER.pack(key, embedding.dtype.str.encode(), len(data))
+        self.file.write(header + data)
+        self.file.flush()
+
+        self.index[key] = (self.size - len(data), embedding.dtype, len(data))
+
+    def clear(self) -> None:
+        self._unmap()
+        self.file.truncate(0)
+        self.file.seek(0)
+        self.index.clear()
+
+    def close(self) -> None:
+        self._unmap()
+        self.file.close()
+
+    def _scan(self) -> None:
+        self.file.seek(0)
+        offset = 0
+
+        while header := self.file.read(RECORD_HEADER.size):
+            if len(header) < RECORD_HEADER.size:
+                break
+            key, dtype, nbytes = RECORD_HEADER.unpack(header)
+            if len(self.file.read(nbytes)) < nbytes:
+                break
+
+            offset += RECORD_HEADER.size
+            self.index[key] = (offset, np.dtype(dtype.rstrip(b"\0").decode()), nbytes)
+            offset += nbytes
+
+        # Drop a record that was only partially written.
+        self.file.truncate(offset)
+        self.file.seek(offset)
+
+    def _remap(self) -> None:
+        self._unmap()
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _unmap(self) -> None:
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+
+class EmbeddingCache:
+    """LRU cache of embeddings keyed by a hash of the text and model, bounded in bytes.
+
+    Evicted entries are spilled to a DiskSegment if a path is given.
+    """
+
+    def __init__(self, max_bytes, path=None, max_disk_bytes=1 << 30) -> None:
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[bytes, np.ndarray] = OrderedDict()
+        self.size = 0
+
+        self.disk = DiskSegment(path, max_disk_bytes) if path else None
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, text: str, model="") -> np.ndarray | None:
+        key = content_key(text, model)
+
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        if self.disk is not None and key in self.disk:
+            self.disk_hits += 1
+            embedding = self.disk.get(key)
+            assert embedding is not None
+            self._insert(key, embedding)
+            return embedding
+
+        self.misses += 1
+        return None
+
+    def put(self, text: str, embedding: np.ndarray, model="") -> None:
+        # Copy, so a row doesn't keep the whole batch alive.
+        self._insert(content_key(text, model), np.array(embedding))
+
+    def close(self) -> None:
+        """Spill all entries to disk, so they are available after a restart."""
+        if self.disk is None:
+            return
+
+        for key, embedding in self.entries.items():
+            self.disk.put(key, embedding)
+        self.disk.close()
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "disk_entries": len(self.disk.index) if self.disk else 0,
+            "disk_bytes": self.disk.size if self.disk else 0,
+        }
+
+    def _insert(self, key: bytes, embedding: np.ndarray) -> None:
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return
+
+        self.entries[key] = embedding
+        self.size += embedding.nbytes
+
+        while self.size > self.max_bytes and self.entries:
+            evicted_key, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.nbytes
+
+            if self.disk is not None:
+                self.disk.put(evicted_key, evicted)
@@ -1,43 +1,123 @@
+import math
 from io import BytesIO
 from typing import List
 
 import numpy as np
+from django.conf import settings
 from django.core.files import File
+from document_embedding.base import DocumentEmbedding
+from document_embedding.pert import PertDocumentEmbedding
+from joblib import Parallel, delayed
 from laser_encoders import LaserEncoderPipeline
-from sklearn.base import ClassifierMixin
+from sentence_transformers import SentenceTransformer
+from sklearn.base import ClassifierMixin, clone
 from sklearn.ensemble import GradientBoostingClassifier, RandomForestClassifier
-from sklearn.model_selection import cross_val_score
+from sklearn.model_selection import StratifiedKFold
 from sklearn.neighbors import KNeighborsClassifier
 from sklearn.svm import SVC
 from sklearn.utils.validation import joblib
 
+from classifier.connection import sample_digest
+from classifier.encoding import encode_documents
 from classifier.models import Classifier, Sample
+from classifier.store import TrainingSet, open_store
 
 
 def generate_embeddings(texts: List[str], encoder: LaserEncoderPipeline):
     return encoder.encode_sentences(texts, normalize_embeddings=True)
 
 
-def find_classifier(X, y):
-    candidates = [
+# Candidates survive a halving round if they are in the best 1/HALVING_FACTOR.
+HALVING_FACTOR = 3
+MAX_FOLDS = 5
+
+
+def default_candidates() -> List[ClassifierMixin]:
+    return [
         RandomForestClassifier(max_depth=7),
         RandomForestClassifier(max_depth=10),
         KNeighborsClassifier(),
         GradientBoostingClassifier(),
         SVC(probability=True),
     ]
-    max_score = -np.inf
-    best_model = None
 
-    for candidate in candidates:
-        score = np.mean(cross_val_score(candidate, X, y))
-        if score > max_score:
-            score = max_score
-            best_model = candidate
 
-    assert best_model is not None
+def _fold_score(candidate: ClassifierMixin, X, y, train, test) -> float:
+    try:
+        return clone(candidate).fit(X[train], y[train]).score(X[test], y[test])
+    except ValueError:
+        # A fold of a small subset can miss classes.
+        return np.nan
+
+
+def _stratified_order(y, rng: np.random.Generator) -> np.ndarray:
+    """Shuffled sample indices, every prefix holds the classes in about their overall ratio."""
+    position = np.empty(len(y))
+
+    for label in np.unique(y):
+        indices = rng.permutation(np.flatnonzero(y == label))
+        position[indices] = (np.arange(len(indices)) + rng.random()) / len(indices)
+
+    return np.argsort(position, kind="stable")
+
+
+def _subset_sizes(y, count, n_splits, factor) -> List[int]:
+    """Sample counts of the halving rounds, the last round uses all samples.
+
+    The smallest subset keeps about n_splits samples of the rarest class.
+    """
+    smallest = math.ceil(n_splits * len(y) / np.unique(y, return_counts=True)[1].min())
+    sizes = [len(y)]
+
+    # A round is only added if at least 2 candidates survive it, so the
+    # winner is always chosen on all samples.
+    while math.ceil(count / factor) > 1 and sizes[0] // factor >= smallest:
+        sizes.insert(0, sizes[0] // factor)
+        count = math.ceil(count / factor)
+
+    return sizes
 
-    return best_model.fit(X, y)
+
+def find_classifier(X, y, candidates=default_candidates, factor=HALVING_FACTOR, n_jobs=-1, seed=0):
+    """Select the candidate with the best cross validation score and fit it on all samples.
+
+    Candidates are compared by successive halving: every round cross
+    validates the remaining candidates on a larger subset of the samples and
+    keeps the best 1/factor of them, the last round uses all samples. The
+    folds of a round are shared by all candidates, all folds of all
+    candidates are fitted in parallel.
+    """
+    X, y = np.asarray(X), np.asarray(y)
+    remaining = candidates() if callable(candidates) else list(candidates)
+    rng = np.random.default_rng(seed)
+
+    n_splits = max(2, min(MAX_FOLDS, np.unique(y, return_counts=True)[1].min()))
+    order = _stratified_order(y, rng)
+    parallel = Parallel(n_jobs=n_jobs)
+
+    for size in _subset_sizes(y, len(remaining), n_splits, factor):
+        if len(remaining) == 1:
+            break
+
+        subset = np.sort(order[:size])
+        cv = StratifiedKFold(n_splits, shuffle=True, random_state=int(rng.integers(1 << 31)))
+        folds = [(subset[train], subset[test]) for train, test in cv.split(X[subset], y[subset])]
+
+        scores = parallel(
+            delayed(_fold_score)(candidate, X, y, train, test)
+            for candidate in remaining
+            for train, test in folds
+        )
+        means = np.nan_to_num(
+            np.nanmean(np.reshape(scores, (len(remaining), len(folds))), axis=1),
+            nan=-np.inf,
+        )
+
+        keep = 1 if size == len(y) else math.ceil(len(remaining) / factor)
+        ranking = np.argsort(-means, kind="stable")[:keep]
+        remaining = [remaining[i] for i in ranking]
+
+    return clone(remaining[0]).fit(X, y)
 
 
 def train_classifier(model: Classifier):
@@ -72,6 +152,41 @@ def store_classifier(model: Classifier, classifier: ClassifierMixin):
     model.model.save(file.name, file)
 
 
+def export_classifier(
+    path,
+    key,
+    samples: List[str],
+    labels: List,
+    ids=None,
+    model=None,
+    candidates=default_candidates,
+    encoder: DocumentEmbedding | None = None,
+) -> int:
+    """Train a classifier offline and save it, with its training set, to the server's store.
+
+    The samples are embedded like the server does, with the sentence model
+    named by model (None for the default model of the server), so the
+    classifier fits the embeddings the server predicts on. The LASER
+    embeddings of train_classifier don't. With the training set the server
+    can train the classifier incrementally later. The server swaps it in on
+    its next reload, see the reload command and API_RELOAD_INTERVAL.
+    Returns the new version of the classifier.
+    """
+    if encoder is None:
+        encoder = PertDocumentEmbedding(SentenceTransformer(model or settings.SBERT_MODEL))
+    embeddings = encode_documents(encoder, samples)
+    classifier = find_classifier(embeddings, labels, candidates)
+
+    training_set = TrainingSet()
+    training_set.add(
+        range(len(samples)) if ids is None else ids,
+        map(sample_digest, samples, labels),
+        labels,
+        embeddings,
+    )
+    return open_store(path).save(key, classifier, training_set, model)
+
+
 def load_classifier(model: Classifier):
     classifier: RandomForestClassifier = joblib.load(model.model)
 
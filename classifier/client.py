@@ -1,44 +1,268 @@
+import asyncio
+import bisect
+import hashlib
+import itertools
+import logging
+import os
+import random
 import socket
-from contextlib import contextmanager
-from uuid import uuid4
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager, suppress
+from typing import AsyncIterator, Deque, Dict, Iterable, Iterator, List, Tuple
+from uuid import UUID, uuid4
 
 import numpy as np
 
 from classifier.connection import (
+    LOCAL_PROTOCOLS,
+    OVERLOADED,
+    PROTOCOL_JOBLIB,
+    PROTOCOL_LOCAL,
+    PROTOCOL_SHARED_MEMORY,
+    PROTOCOLS,
     Closed,
     Command,
+    CommandError,
+    Overloaded,
     Result,
+    ServerException,
     gen_key,
+    receive_result,
     receive_result_sync,
+    sample_digest,
+    send_command,
     send_command_sync,
 )
 
+LOG = logging.getLogger("client")
+
+POOL_SIZE = int(os.environ.get("API_POOL_SIZE", 0)) or 4
+POOL_IDLE_TIMEOUT = int(os.environ.get("API_POOL_IDLE_TIMEOUT", 0)) or 300  # Seconds
+POOL_HEALTH_INTERVAL = int(os.environ.get("API_POOL_HEALTH_INTERVAL", 0)) or 30  # Seconds
+
+# Retries of commands rejected by an overloaded server.
+RETRIES = int(os.environ.get("API_RETRIES", 3))
+RETRY_BACKOFF = (int(os.environ.get("API_RETRY_BACKOFF_MS", 0)) or 100) / 1000
+
+FINISHED_PHASES = ("done", "failed", "cancelled", "superseded")
+
+# Commands that can be sent again on a new connection if the old one broke.
+IDEMPOTENT_COMMANDS = ("ping", "stats", "embedding", "predict", "training_set", "job_status")
+
+# Large arrays can be passed in shared memory on unix sockets, if /dev/shm is
+# shared with the server. It is not with separate containers, so it is opt-in.
+SHARED_MEMORY = os.environ.get("API_SHARED_MEMORY") == "1"
+
+# Points of every server on the hash ring, more points spread the keys more evenly.
+RING_REPLICAS = 128
+
+# Documents per embedding command and commands in flight while streaming.
+STREAM_CHUNK_SIZE = 64
+STREAM_WINDOW = 4
+
+
+def _backoff(attempt) -> float:
+    """Seconds to wait before retrying, exponential with jitter."""
+    return RETRY_BACKOFF * 2**attempt * random.uniform(0.5, 1.5)
+
+
+def _error(result: ServerException) -> CommandError:
+    if result.code == OVERLOADED:
+        return Overloaded(result.error)
+    return CommandError(result.error)
+
+
+def _key(secret, derived_key, socket_path):
+    # Clients on the unix socket don't need the secret.
+    if socket_path and not (secret or derived_key):
+        return None
+    return gen_key(secret, derived_key)
+
+
+def _protocols(socket_path) -> Tuple[int, ...]:
+    """Protocols offered to the server, the first one is used to connect."""
+    if socket_path is None:
+        return PROTOCOLS
+    if SHARED_MEMORY:
+        return LOCAL_PROTOCOLS
+    return tuple(p for p in LOCAL_PROTOCOLS if p != PROTOCOL_SHARED_MEMORY)
+
+
+def _chunks(documents: Iterable, size) -> Iterator[List]:
+    iterator = iter(documents)
+    while chunk := list(itertools.islice(iterator, size)):
+        yield chunk
+
+
+def _payload(result: Result | None):
+    if result is None:
+        raise ValueError("No result returned!")
+
+    return result.payload
+
+
+def _update_command(key, samples: Dict, current: Dict, model=None) -> Command | None:
+    """Create the train command for the samples that changed compared to the server."""
+    added = {
+        sample_id: (sample, label)
+        for sample_id, (sample, label) in samples.items()
+        if current.get(sample_id) != sample_digest(sample, label)
+    }
+    removed = [sample_id for sample_id in current if sample_id not in samples]
+
+    if not added and not removed:
+        return None
+
+    return Command(
+        "train",
+        uuid4(),
+        {
+            "key": key,
+            "ids": list(added),
+            "samples": [sample for sample, _ in added.values()],
+            "labels": [label for _, label in added.values()],
+            "removed": removed,
+            "model": model,
+        },
+    )
+
 
 class Client:
-    def __init__(self, host, port, secret) -> None:
+    def __init__(self, host, port, secret, derived_key=None, socket_path=None) -> None:
         self.host = host
         self.port = port
-        self.key = gen_key(secret)
+        # Connect through the unix socket of a server on the same host instead.
+        self.socket_path = socket_path
+        self.local = socket_path is not None
+        self.key = _key(secret, derived_key, socket_path)
+        self.protocol = PROTOCOL_JOBLIB
+
+        # Results that arrived while waiting for another command.
+        self.results: Dict[UUID, Result | ServerException] = {}
+        self.send_lock = threading.Lock()
+        self.receive_lock = threading.Lock()
+        self.connected = False
+
+    @property
+    def shared_memory(self) -> bool:
+        """Whether arrays in shared memory are accepted from the server."""
+        return self.local and self.protocol == PROTOCOL_SHARED_MEMORY
 
     def connect(self):
-        self.socket = socket.create_connection((self.host, self.port))
-        self.send_command(Command("connect", uuid4(), {}))
+        if self.local:
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.connect(self.socket_path)
+            self.protocol = PROTOCOL_LOCAL
+        else:
+            self.socket = socket.create_connection((self.host, self.port))
+            self.protocol = PROTOCOL_JOBLIB
+        self.connected = True
+        self.results.clear()
+
+        protocols = _protocols(self.socket_path)
+        result = self.send_command(Command("connect", uuid4(), {"protocols": protocols}))
+
+        # Servers without frame support answer with a plain "success".
+        if result is not None and isinstance(result.payload, dict):
+            self.protocol = result.payload.get("protocol", PROTOCOL_JOBLIB)
 
     def disconnect(self):
         self.send_command(Command("close", uuid4(), None))
 
+    def close(self):
+        """Close the socket without notifying the server."""
+        self.connected = False
+        self.socket.close()
+
     def ping(self):
         return self.send_command(Command("ping", uuid4(), None))
 
+    def stats(self) -> dict:
+        result = self.send_command(Command("stats", uuid4(), None))
+
+        if result is None:
+            raise ValueError("No result returned!")
+
+        return result.payload
+
+    def submit(self, command: Command) -> UUID:
+        """Send a command without waiting for its result."""
+        with self.send_lock:
+            send_command_sync(self.socket, command, self.key, self.protocol)
+        return command.uuid
+
+    def wait(self, uuid: UUID) -> Result | None:
+        """Wait for the result of a submitted command.
+
+        Results of other commands received in the meantime are kept until
+        their owner asks for them, so replies may arrive in any order.
+        """
+        with self.receive_lock:
+            while uuid not in self.results:
+                result = receive_result_sync(self.socket, self.key, self.local, self.shared_memory)
+
+                if isinstance(result, Closed):
+                    self.close()
+                    return None
+
+                self.results[result.uuid] = result
+
+        result = self.results.pop(uuid)
+
+        if isinstance(result, ServerException):
+            raise _error(result)
+
+        return result
+
     def send_command(self, command: Command) -> Result | None:
-        send_command_sync(self.socket, command, self.key)
-        result = receive_result_sync(self.socket, self.key)
+        """Send the command and wait for its result, retried while the server is overloaded.
+
+        Idempotent commands are sent once more on a new connection if the
+        connection broke, pooled connections may have gone stale.
+        """
+        try:
+            result = self._send_command(command)
+        except (OSError, EOFError) as ex:
+            if command.name not in IDEMPOTENT_COMMANDS:
+                raise
+            LOG.info("Connection to %s:%s broke, reconnecting: %s", self.host, self.port, ex)
+        else:
+            if result is not None or command.name not in IDEMPOTENT_COMMANDS:
+                return result
+            LOG.info("Connection to %s:%s was closed, reconnecting", self.host, self.port)
+
+        self.reconnect()
+        return self._send_command(command)
+
+    def _send_command(self, command: Command) -> Result | None:
+        for attempt in range(RETRIES):
+            try:
+                return self.wait(self.submit(command))
+            except Overloaded:
+                time.sleep(_backoff(attempt))
+
+        return self.wait(self.submit(command))
 
-        if isinstance(result, Closed):
+    def reconnect(self):
+        with suppress(OSError):
             self.socket.close()
-            return None
+        self.connect()
 
-        return result
+    def send_commands(self, commands: List[Command]) -> List[Result | None]:
+        """Pipeline several commands on the connection and return their results in order."""
+        uuids = [self.submit(command) for command in commands]
+        results = []
+
+        for command, uuid in zip(commands, uuids):
+            try:
+                results.append(self.wait(uuid))
+            except Overloaded:
+                time.sleep(_backoff(0))
+                results.append(self.send_command(command))
+
+        return results
 
     def predict_class(self, key, values):
         uuid = uuid4()
@@ -51,21 +275,97 @@ class Client:
 
         return result.payload
 
-    def get_embedding(self, sentence) -> np.ndarray:
+    def get_embedding(self, sentence, model=None, dtype="float32") -> np.ndarray:
+        """Embed the sentence with the model, the default model of the server if None.
+
+        dtype is one of EMBEDDING_DTYPES, int8 embeddings are returned as a
+        tuple of codes and scales, see expand_embeddings.
+        """
         uuid = uuid4()
 
-        result = self.send_command(Command("embedding", uuid, {"sentence": sentence}))
+        result = self.send_command(
+            Command(
+                "embedding", uuid, {"sentence": sentence, "model": model, "dtype": dtype}
+            )
+        )
 
         if result is None:
             raise ValueError("No result returned!")
 
         return result.payload
 
-    def train_classifier(self, key, samples, labels, config=None):
+    def get_embeddings(self, sentences: List, model=None, dtype="float32") -> List[np.ndarray]:
+        """Request the embeddings of several inputs at once, pipelined on the connection."""
+        payload = {"model": model, "dtype": dtype}
+        results = self.send_commands(
+            [
+                Command("embedding", uuid4(), {"sentence": sentence, **payload})
+                for sentence in sentences
+            ]
+        )
+
+        return [_payload(result) for result in results]
+
+    def stream_embeddings(
+        self,
+        documents: Iterable[str],
+        model=None,
+        dtype="float32",
+        chunk_size=STREAM_CHUNK_SIZE,
+        window=STREAM_WINDOW,
+    ) -> Iterator[np.ndarray]:
+        """Embed the documents in chunks, yields the embeddings of each chunk in order.
+
+        Documents are read from the iterable as needed and at most window
+        chunks are in flight, so memory stays bounded on both ends and the
+        caller can process a chunk while the next ones are encoded.
+        """
+        chunks = _chunks(documents, chunk_size)
+        pending: Deque[Tuple[Command, UUID]] = deque()
+
+        def submit(chunk):
+            cmd = Command(
+                "embedding", uuid4(), {"sentence": chunk, "model": model, "dtype": dtype}
+            )
+            pending.append((cmd, self.submit(cmd)))
+
+        try:
+            for chunk in itertools.islice(chunks, window):
+                submit(chunk)
+
+            while pending:
+                cmd, uuid = pending.popleft()
+                try:
+                    result = self.wait(uuid)
+                except Overloaded:
+                    time.sleep(_backoff(0))
+                    result = self.send_command(cmd)
+
+                # Keep the window full while the caller works on this chunk.
+                for chunk in itertools.islice(chunks, 1):
+                    submit(chunk)
+
+                yield _payload(result)
+        except (OSError, EOFError):
+            # The connection is gone, no replies are left to drain.
+            pending.clear()
+            raise
+        finally:
+            # Drain the replies of an abandoned stream, the client is reused.
+            # A connection lost meanwhile is noticed by the next command.
+            with suppress(OSError, EOFError):
+                for _, uuid in pending:
+                    try:
+                        self.wait(uuid)
+                    except CommandError:
+                        pass
+
+    def train_classifier(self, key, samples, labels, config=None, model=None) -> dict:
+        """Start training a classifier on the server, returns the status of the job."""
         if config is None:
             config = {}
         uuid = uuid4()
-        return self.send_command(
+        result = self.send_command(
             Command(
                 "train",
                 uuid,
@@ -73,17 +373,553 @@ class Client:
                     "key": key,
                     "samples": samples,
                     "labels": labels,
+                    "model": model,
                 },
             )
         )
+        return _payload(result)
+
+    def update_classifier(self, key, samples: Dict, model=None) -> dict | None:
+        """Train a classifier incrementally, only samples changed since the last training are sent.
+
+        samples maps stable sample ids to (sample, label) tuples. Returns the
+        status of the job, or None if nothing changed.
+        """
+        cmd = Command("training_set", uuid4(), {"key": key, "model": model})
+        current = _payload(self.send_command(cmd))
+
+        update = _update_command(key, samples, current, model)
+        if update is None:
+            return None
+
+        return _payload(self.send_command(update))
+
+    def reload(self) -> dict:
+        """Make the server swap in classifiers saved to its store by other processes."""
+        return _payload(self.send_command(Command("reload", uuid4(), None)))
+
+    def job_status(self, job_id) -> dict:
+        return _payload(self.send_command(Command("job_status", uuid4(), {"job": job_id})))
+
+    def cancel_job(self, job_id) -> dict:
+        return _payload(self.send_command(Command("cancel_job", uuid4(), {"job": job_id})))
+
+    def wait_for_job(self, job_id, interval=1.0, timeout=None) -> dict:
+        """Poll the status of a job until it is finished."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while (status := self.job_status(job_id))["phase"] not in FINISHED_PHASES:
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError(f"Job {job_id} did not finish in time")
+            time.sleep(interval)
+
+        return status
+
+
+class AsyncClient:
+    """Asyncio version of Client, any number of commands can be awaited concurrently."""
+
+    def __init__(self, host, port, secret, derived_key=None, socket_path=None) -> None:
+        self.host = host
+        self.port = port
+        self.socket_path = socket_path
+        self.local = socket_path is not None
+        self.key = _key(secret, derived_key, socket_path)
+        self.protocol = PROTOCOL_JOBLIB
+
+        self.pending: Dict[UUID, asyncio.Future] = {}
+        self.lock = asyncio.Lock()
+        self.reader_task: asyncio.Task | None = None
+
+    @property
+    def shared_memory(self) -> bool:
+        """Whether arrays in shared memory are accepted from the server."""
+        return self.local and self.protocol == PROTOCOL_SHARED_MEMORY
+
+    async def connect(self):
+        if self.local:
+            self.reader, self.writer = await asyncio.open_unix_connection(self.socket_path)
+            self.protocol = PROTOCOL_LOCAL
+        else:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+            self.protocol = PROTOCOL_JOBLIB
+
+        cmd = Command("connect", uuid4(), {"protocols": _protocols(self.socket_path)})
+        await send_command(self.writer, cmd, self.key, self.protocol)
+        result = await receive_result(self.reader, self.key, self.local, self.shared_memory)
+
+        if isinstance(result, Result) and isinstance(result.payload, dict):
+            self.protocol = result.payload.get("protocol", PROTOCOL_JOBLIB)
+
+        self.reader_task = asyncio.create_task(self._read_results())
+
+    async def disconnect(self):
+        # The server answers the close command by closing the connection.
+        with suppress(ConnectionResetError):
+            await self.send_command(Command("close", uuid4(), None))
+        self.writer.close()
+
+        if self.reader_task is not None:
+            await self.reader_task
+
+    async def ping(self):
+        return await self.send_command(Command("ping", uuid4(), None))
+
+    async def stats(self) -> dict:
+        result = await self.send_command(Command("stats", uuid4(), None))
+
+        if result is None:
+            raise ValueError("No result returned!")
+
+        return result.payload
+
+    async def send_command(self, command: Command) -> Result | None:
+        """Send the command and wait for its result, retried while the server is overloaded."""
+        for attempt in range(RETRIES):
+            try:
+                return await self._send_command(command)
+            except Overloaded:
+                await asyncio.sleep(_backoff(attempt))
+
+        return await self._send_command(command)
+
+    async def _send_command(self, command: Command) -> Result | None:
+        if self.reader_task is not None and self.reader_task.done():
+            raise ConnectionResetError("Connection closed by the server")
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending[command.uuid] = future
+
+        try:
+            async with self.lock:
+                await send_command(self.writer, command, self.key, self.protocol)
+        except BaseException:
+            self.pending.pop(command.uuid, None)
+            raise
+
+        return await future
+
+    async def _read_results(self):
+        """Resolve the futures of the pending commands as their results arrive.
+
+        Commands still pending when the connection closes fail.
+        """
+        error: BaseException = ConnectionResetError("Connection closed by the server")
+
+        try:
+            while True:
+                result = await receive_result(self.reader, self.key, self.local, self.shared_memory)
+
+                if isinstance(result, Closed):
+                    break
+
+                future = self.pending.pop(result.uuid, None)
+
+                if future is None or future.done():
+                    LOG.warning("Received result for unknown command %s", result.uuid)
+                elif isinstance(result, ServerException):
+                    future.set_exception(_error(result))
+                else:
+                    future.set_result(result)
+        except Exception as ex:
+            error = ex
+        finally:
+            pending, self.pending = self.pending, {}
+
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(error)
+
+    async def predict_class(self, key, values):
+        result = await self.send_command(
+            Command("predict", uuid4(), {"key": key, "sentences": values})
+        )
+
+        if result is None:
+            raise ValueError("No result returned!")
+
+        return result.payload
+
+    async def get_embedding(self, sentence, model=None, dtype="float32") -> np.ndarray:
+        payload = {"sentence": sentence, "model": model, "dtype": dtype}
+        result = await self.send_command(Command("embedding", uuid4(), payload))
+
+        if result is None:
+            raise ValueError("No result returned!")
+
+        return result.payload
+
+    async def get_embeddings(self, sentences: List, model=None, dtype="float32") -> List[np.ndarray]:
+        """Request the embeddings of several inputs concurrently."""
+        return list(
+            await asyncio.gather(
+                *(self.get_embedding(sentence, model, dtype) for sentence in sentences)
+            )
+        )
+
+    async def stream_embeddings(
+        self,
+        documents: Iterable[str],
+        model=None,
+        dtype="float32",
+        chunk_size=STREAM_CHUNK_SIZE,
+        window=STREAM_WINDOW,
+    ) -> AsyncIterator[np.ndarray]:
+        """Embed the documents in chunks, see Client.stream_embeddings."""
+        chunks = _chunks(documents, chunk_size)
+        pending: Deque[asyncio.Task] = deque()
+
+        def submit(chunk):
+            pending.append(asyncio.create_task(self.get_embedding(chunk, model, dtype)))
+
+        try:
+            for chunk in itertools.islice(chunks, window):
+                submit(chunk)
+
+            while pending:
+                embeddings = await pending.popleft()
+                for chunk in itertools.islice(chunks, 1):
+                    submit(chunk)
+                yield embeddings
+        finally:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def train_classifier(self, key, samples, labels, config=None, model=None) -> dict:
+        """Start training a classifier on the server, returns the status of the job."""
+        result = await self.send_command(
+            Command(
+                "train",
+                uuid4(),
+                {
+                    "key": key,
+                    "samples": samples,
+                    "labels": labels,
+                    "model": model,
+                },
+            )
+        )
+        return _payload(result)
+
+    async def update_classifier(self, key, samples: Dict, model=None) -> dict | None:
+        """Train a classifier incrementally, see Client.update_classifier."""
+        cmd = Command("training_set", uuid4(), {"key": key, "model": model})
+        current = _payload(await self.send_command(cmd))
+
+        update = _update_command(key, samples, current, model)
+        if update is None:
+            return None
+
+        return _payload(await self.send_command(update))
+
+    async def reload(self) -> dict:
+        return _payload(await self.send_command(Command("reload", uuid4(), None)))
+
+    async def job_status(self, job_id) -> dict:
+        cmd = Command("job_status", uuid4(), {"job": job_id})
+        return _payload(await self.send_command(cmd))
+
+    async def cancel_job(self, job_id) -> dict:
+        cmd = Command("cancel_job", uuid4(), {"job": job_id})
+        return _payload(await self.send_command(cmd))
+
+    async def wait_for_job(self, job_id, interval=1.0, timeout=None) -> dict:
+        """Poll the status of a job until it is finished."""
+
+        async def poll():
+            while (status := await self.job_status(job_id))["phase"] not in FINISHED_PHASES:
+                await asyncio.sleep(interval)
+            return status
+
+        return await asyncio.wait_for(poll(), timeout)
+
+
+class ClientPool:
+    """Keeps connected clients to one server around, so they can be reused.
+
+    At most size clients are handed out at the same time, idle clients are
+    checked with a ping before reuse and dropped after idle_timeout seconds.
+    """
+
+    def __init__(
+        self,
+        host,
+        port,
+        secret,
+        derived_key=None,
+        socket_path=None,
+        size=POOL_SIZE,
+        idle_timeout=POOL_IDLE_TIMEOUT,
+        health_interval=POOL_HEALTH_INTERVAL,
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.secret = secret
+        self.derived_key = derived_key
+        self.socket_path = socket_path
+        self.idle_timeout = idle_timeout
+        self.health_interval = health_interval
+
+        self.idle: List[Tuple[Client, float]] = []
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(size)
+
+    def acquire(self, timeout=None) -> Client:
+        """Return a connected client, waits if all clients are in use."""
+        if not self.slots.acquire(timeout=timeout):
+            raise TimeoutError("No classifier connection available")
+
+        try:
+            return self._checkout()
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def release(self, client: Client, broken=False) -> None:
+        """Give a client back to the pool, broken clients are closed instead."""
+        if broken or not client.connected:
+            client.close()
+        else:
+            with self.lock:
+                self.idle.append((client, time.monotonic()))
+        self.slots.release()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """Provides a context manager for a client of the pool.
+
+        The client is only reused if the block finished or failed with a
+        CommandError, anything else may leave unread data on the connection.
+        """
+        client = self.acquire(timeout)
+        try:
+            yield client
+        except CommandError:
+            self.release(client)
+            raise
+        except BaseException:
+            self.release(client, broken=True)
+            raise
+        else:
+            self.release(client)
+
+    def clear(self) -> None:
+        """Close all idle clients."""
+        with self.lock:
+            idle, self.idle = self.idle, []
+
+        for client, _ in idle:
+            client.close()
+
+    def _checkout(self) -> Client:
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                # Most recently used first, the others are allowed to time out.
+                client, last_used = self.idle.pop()
+
+            idle_time = time.monotonic() - last_used
+
+            if idle_time > self.idle_timeout:
+                client.close()
+            elif idle_time < self.health_interval or self._is_healthy(client):
+                return client
+
+        client = Client(self.host, self.port, self.secret, self.derived_key, self.socket_path)
+        client.connect()
+        return client
+
+    def _is_healthy(self, client: Client) -> bool:
+        try:
+            return client.ping() is not None
+        except (OSError, EOFError, CommandError):
+            LOG.info("Dropping broken connection to %s:%s", self.host, self.port)
+            client.close()
+            return False
+
+
+_pools: Dict[Tuple, ClientPool] = {}
+_pools_lock = threading.Lock()
+
+
+def _reset_pools():
+    # Connections are not shared with forked children (celery prefork).
+    global _pools_lock
+    _pools.clear()
+    _pools_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_pools)
+
+
+def get_pool(host, port, secret, derived_key=None, socket_path=None) -> ClientPool:
+    """Return the process wide client pool for host, port and secret."""
+    key = (host, port, secret, derived_key, socket_path)
+
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ClientPool(host, port, secret, derived_key, socket_path)
+        return _pools[key]
 
 
 @contextmanager
-def connect(host, port, secret):
-    """Provides a context manager for a client connection to host and port"""
-    client = Client(host, port, secret)
-    client.connect()
+def connect(host, port, secret, derived_key=None, socket_path=None):
+    """Provides a context manager for a pooled client connection to host and port"""
+    with get_pool(host, port, secret, derived_key, socket_path).connection() as client:
+        yield client
+
+
+@asynccontextmanager
+async def async_connect(host, port, secret, derived_key=None, socket_path=None):
+    """Provides an async context manager for a client connection to host and port"""
+    client = AsyncClient(host, port, secret, derived_key, socket_path)
+    await client.connect()
     try:
         yield client
     finally:
-        client.disconnect()
+        await client.disconnect()
+
+
+def parse_endpoint(endpoint: str) -> Tuple[str | None, int | None, str | None]:
+    """Split "host:port", or "unix:/path" for a unix socket, into host, port and socket path."""
+    if endpoint.startswith("unix:"):
+        return None, None, endpoint.removeprefix("unix:")
+
+    host, _, port = endpoint.rpartition(":")
+    return host, int(port), None
+
+
+def _ring_hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """Consistent hashing of keys to nodes.
+
+    Every node owns many points on the ring and a key belongs to the node of
+    the next point, so adding a node only moves the keys it takes over.
+    """
+
+    def __init__(self, nodes: Iterable[str], replicas=RING_REPLICAS) -> None:
+        points = sorted(
+            (_ring_hash(f"{node}#{i}"), node) for node in nodes for i in range(replicas)
+        )
+        if not points:
+            raise ValueError("A hash ring needs at least one node")
+
+        self.hashes = [point for point, _ in points]
+        self.nodes = [node for _, node in points]
+
+    def node(self, key) -> str:
+        index = bisect.bisect(self.hashes, _ring_hash(str(key))) % len(self.hashes)
+        return self.nodes[index]
+
+
+class ShardedClient:
+    """Spreads the commands over several servers, each with its own client pool.
+
+    Commands of a classifier go to the server that owns its key on the hash
+    ring. Embeddings are stateless, they are balanced round-robin over all
+    servers and retried on the next one if a server can't be reached. A key
+    that moves to a new server is loaded from a shared store, or trained
+    from scratch by update_classifier.
+    """
+
+    def __init__(self, endpoints: Iterable[str], secret, derived_key=None) -> None:
+        self.endpoints = list(dict.fromkeys(endpoints))
+        self.secret = secret
+        self.derived_key = derived_key
+        self.ring = HashRing(self.endpoints)
+        self.turn = itertools.count()
+
+    def pool(self, endpoint) -> ClientPool:
+        # Looked up on every use, pools are replaced in forked children.
+        host, port, socket_path = parse_endpoint(endpoint)
+        return get_pool(host, port, self.secret, self.derived_key, socket_path)
+
+    @contextmanager
+    def connection(self, key, timeout=None):
+        """Provides a pooled client of the server owning the classifier key."""
+        with self.pool(self.ring.node(key)).connection(timeout) as client:
+            yield client
+
+    def predict_class(self, key, values):
+        with self.connection(key) as client:
+            return client.predict_class(key, values)
+
+    def train_classifier(self, key, samples, labels, config=None, model=None) -> dict:
+        with self.connection(key) as client:
+            return client.train_classifier(key, samples, labels, config, model)
+
+    def update_classifier(self, key, samples: Dict, model=None) -> dict | None:
+        with self.connection(key) as client:
+            return client.update_classifier(key, samples, model)
+
+    def get_embedding(self, sentence, model=None, dtype="float32") -> np.ndarray:
+        return self._balanced(lambda client: client.get_embedding(sentence, model, dtype))
+
+    def get_embeddings(self, sentences: List, model=None, dtype="float32") -> List[np.ndarray]:
+        return self._balanced(lambda client: client.get_embeddings(sentences, model, dtype))
+
+    def stream_embeddings(self, documents: Iterable[str], model=None, dtype="float32", **options):
+        """Stream the embeddings from one server, see Client.stream_embeddings.
+
+        Only connecting fails over to the next server, once streaming the
+        documents are partly consumed and errors are raised.
+        """
+        pool, client = self._acquire()
+        broken = False
+
+        try:
+            yield from client.stream_embeddings(documents, model, dtype, **options)
+        except CommandError:
+            raise
+        except BaseException:
+            broken = True
+            raise
+        finally:
+            pool.release(client, broken)
+
+    def _rotation(self) -> List[str]:
+        start = next(self.turn) % len(self.endpoints)
+        return self.endpoints[start:] + self.endpoints[:start]
+
+    def _acquire(self) -> Tuple[ClientPool, Client]:
+        """Return a client of the next server that accepts a connection."""
+        endpoints = self._rotation()
+
+        for endpoint in endpoints[:-1]:
+            pool = self.pool(endpoint)
+            try:
+                return pool, pool.acquire()
+            except OSError as ex:
+                LOG.warning("Classifier server %s failed, trying the next one: %s", endpoint, ex)
+
+        pool = self.pool(endpoints[-1])
+        return pool, pool.acquire()
+
+    def _balanced(self, call):
+        """Run call with a client of the next server, the others are tried if it fails."""
+        endpoints = self._rotation()
+
+        for index, endpoint in enumerate(endpoints):
+            try:
+                with self.pool(endpoint).connection() as client:
+                    return call(client)
+            except (OSError, EOFError) as ex:
+                if index == len(endpoints) - 1:
+                    raise
+                LOG.warning("Classifier server %s failed, trying the next one: %s", endpoint, ex)
+
+
+_clusters: Dict[Tuple, ShardedClient] = {}
+
+
+def get_cluster(endpoints: Iterable[str], secret, derived_key=None) -> ShardedClient:
+    """Return the process wide sharded client for the endpoints and secret."""
+    key = (tuple(endpoints), secret, derived_key)
+
+    with _pools_lock:
+        if key not in _clusters:
+            _clusters[key] = ShardedClient(endpoints, secret, derived_key)
+        return _clusters[key]
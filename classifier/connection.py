@@ -1,20 +1,34 @@
 """Helper functions to send and receive objects over socket streams."""
 import asyncio
 import base64
+import hashlib
+import json
 import logging
 import os
+import queue
 import socket
+import struct
+import threading
+import time
 from asyncio.exceptions import IncompleteReadError
+from contextlib import suppress
 from dataclasses import dataclass
+from functools import lru_cache, partial
 from io import BytesIO
-from typing import Any, Tuple
+from multiprocessing import resource_tracker, shared_memory
+from typing import Any, Dict, Iterator, List, Tuple
 from uuid import UUID
 
 import joblib
-from cryptography.fernet import Fernet
+import numpy as np
+from cryptography.fernet import Fernet, InvalidToken
 from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 
+from classifier.metrics import METRICS
+
 LOG = logging.getLogger("connections")
 
 INT_LENGTH = 8
@@ -22,6 +36,33 @@ INT_LENGTH = 8
 SALT = os.environ.get("SALT", "wYfJIy4Nx1hPcxiljwg").encode()
 ITERATIONS = int(os.environ.get("KDF_ITERATIONS", "0")) or 1 << 18
 FERNET_TTL = int(os.environ.get("FERNET_TTL", 0)) or 60  # Seconds
+MAX_CLOCK_SKEW = 60  # Seconds, same allowance as Fernet
+
+# Wire protocols, negotiated with the connect command.
+PROTOCOL_JOBLIB = 1  # joblib dump, Fernet token
+PROTOCOL_FRAMES = 2  # typed header and raw array buffers, AES-GCM per segment
+PROTOCOL_LOCAL = 3  # frames without encryption, only on unix sockets
+PROTOCOL_SHARED_MEMORY = 4  # local frames, large arrays are passed in shared memory
+PROTOCOLS = (PROTOCOL_FRAMES, PROTOCOL_JOBLIB)
+LOCAL_PROTOCOLS = (PROTOCOL_SHARED_MEMORY, PROTOCOL_LOCAL, *PROTOCOLS)
+
+# Arrays smaller than this are cheaper to copy through the socket.
+SHARED_MEMORY_MIN_BYTES = 1 << 20
+
+FRAME_VERSION = 2
+LOCAL_FRAME_VERSION = 3
+FRAME_PREAMBLE = struct.Struct(">BBHd")  # version, kind, segment count, timestamp
+SEGMENT_HEADER = struct.Struct(">Q12s")  # ciphertext length, nonce
+NONCE_LENGTH = 12
+
+KIND_OBJECT = 0
+KIND_COMMAND = 1
+KIND_RESULT = 2
+
+EMBEDDING_DTYPES = ("float32", "float16", "int8")
+
+# Code of the ServerException returned when the server rejects a command under load.
+OVERLOADED = "overloaded"
 
 
 @dataclass
@@ -41,21 +82,336 @@ class Result:
 class ServerException:
     error: str
     uuid: UUID
+    code: str | None = None
 
 
 class Closed:
     pass
 
 
-def gen_key(secret: str):
-    """Return a key derived from the secert."""
+class CommandError(Exception):
+    """Raised on the client when the server failed to process a command."""
+
+
+class Overloaded(CommandError):
+    """Raised on the client when the server rejected a command, it may be retried later."""
+
+
+class Key(Fernet):
+    """Fernet key that also carries the AEAD cipher used for binary frames."""
+
+    def __init__(self, key: bytes) -> None:
+        super().__init__(base64.urlsafe_b64encode(key))
+        frame_key = HKDF(hashes.SHA256(), 32, salt=None, info=b"frames").derive(key)
+        self.aead = AESGCM(frame_key)
+
+
+@lru_cache(maxsize=None)
+def derive_key(secret: str, salt: bytes = SALT, iterations: int = ITERATIONS) -> bytes:
+    """Stretch the secret with PBKDF2, the result is cached for the whole process."""
     kdf = PBKDF2HMAC(
         hashes.SHA256(),
         32,
-        salt=SALT,
-        iterations=ITERATIONS,
+        salt=salt,
+        iterations=iterations,
     )
-    return Fernet(base64.urlsafe_b64encode(kdf.derive(secret.encode())))
+    return kdf.derive(secret.encode())
+
+
+def gen_key(secret: str, derived_key: str | None = None) -> Key:
+    """Return a key derived from the secert.
+
+    If derived_key (the url-safe base64 output of derive_key) is given, the
+    key derivation is skipped entirely.
+    """
+    if derived_key:
+        return Key(base64.urlsafe_b64decode(derived_key))
+    return Key(derive_key(secret, SALT, ITERATIONS))
+
+
+def sample_digest(sample: str, label) -> str:
+    """Digest of a training sample, used to find changed samples for incremental training."""
+    return hashlib.blake2b(f"{label}\0{sample}".encode(), digest_size=16).hexdigest()
+
+
+def negotiate_protocol(offered, supported=PROTOCOLS) -> int:
+    """Return the highest protocol supported by both sides."""
+    return max(set(offered or ()) & set(supported), default=PROTOCOL_JOBLIB)
+
+
+def compact_embeddings(embeddings: np.ndarray, dtype="float32"):
+    """Convert embeddings to the dtype sent to the client.
+
+    int8 embeddings are returned as a tuple of the int8 codes and a float32
+    scale per vector, see expand_embeddings.
+    """
+    match dtype:
+        case "float32" | "float16":
+            return embeddings.astype(dtype, copy=False)
+        case "int8":
+            scales = np.abs(embeddings).max(axis=-1, keepdims=True) / 127
+            scales[scales == 0] = 1
+            codes = np.rint(embeddings / scales).astype(np.int8)
+            return codes, scales.astype(np.float32)
+    raise ValueError(f"Unknown embedding dtype: {dtype}")
+
+
+def expand_embeddings(embeddings) -> np.ndarray:
+    """Return float32 embeddings for the result of compact_embeddings."""
+    if isinstance(embeddings, tuple):
+        codes, scales = embeddings
+        return codes.astype(np.float32) * scales
+    return embeddings.astype(np.float32, copy=False)
+
+
+def _is_raw_array(value) -> bool:
+    return isinstance(value, np.ndarray) and value.dtype.kind in "biufc"
+
+
+def _dump(obj, compress=True) -> bytes:
+    with BytesIO() as io:
+        joblib.dump(obj, io, compress=compress)
+        return io.getvalue()
+
+
+def _to_shared_memory(array: np.ndarray) -> str:
+    """Copy the array to a new shared memory block, the receiver unlinks it."""
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    view = np.ndarray(array.shape, array.dtype, buffer=block.buf)
+    view[...] = array
+    del view
+
+    # Owned by the receiver from now on, the tracker of this process must not remove it.
+    resource_tracker.unregister(block._name, "shared_memory")  # type: ignore[attr-defined]
+    block.close()
+    return block.name
+
+
+def _unlink_shared_memory(names: List[str]) -> None:
+    """Remove blocks created for a frame that was not delivered."""
+    for name in names:
+        with suppress(FileNotFoundError):
+            block = shared_memory.SharedMemory(name=name)
+            block.close()
+            block.unlink()
+
+
+def _from_shared_memory(spec: dict) -> np.ndarray:
+    block = shared_memory.SharedMemory(name=spec["shared_memory"])
+    try:
+        view = np.ndarray(spec["shape"], np.dtype(spec["dtype"]), buffer=block.buf)
+        array = view.copy()
+        del view
+    finally:
+        block.close()
+        block.unlink()
+    return array
+
+
+def _encode_payload(payload, compress=True, blocks: List[str] | None = None) -> Tuple[dict, List]:
+    """Split a payload into a header and the buffers to send after it.
+
+    Numeric arrays (or tuples of them) are sent as raw buffers, or in shared
+    memory if blocks is a list and they are large. The names of the shared
+    memory blocks are added to blocks. Everything else falls back to joblib.
+    """
+    if _is_raw_array(payload):
+        kind, arrays = "array", [payload]
+    elif isinstance(payload, tuple) and payload and all(map(_is_raw_array, payload)):
+        kind, arrays = "arrays", list(payload)
+    else:
+        return {"payload": "joblib"}, [_dump(payload, compress)]
+
+    header: Dict[str, Any] = {
+        "payload": kind,
+        "arrays": [{"dtype": array.dtype.str, "shape": array.shape} for array in arrays],
+    }
+
+    if blocks is not None and sum(array.nbytes for array in arrays) >= SHARED_MEMORY_MIN_BYTES:
+        for spec, array in zip(header["arrays"], arrays):
+            spec["shared_memory"] = _to_shared_memory(array)
+            blocks.append(spec["shared_memory"])
+        return header, []
+
+    buffers = [np.ascontiguousarray(array).reshape(-1) for array in arrays]
+    return header, [buffer.data.cast("B") for buffer in buffers]
+
+
+def _decode_arrays(
+    specs: List[dict], buffers: List[bytes | memoryview], shared_memory=False
+) -> List[np.ndarray]:
+    if any("shared_memory" in spec for spec in specs):
+        if not shared_memory:
+            raise ValueError("Shared memory arrays were not negotiated")
+        return [_from_shared_memory(spec) for spec in specs]
+    return list(map(_frombuffer, specs, buffers))
+
+
+def _decode_payload(header: dict, buffers: List[bytes | memoryview], shared_memory=False) -> Any:
+    match header["payload"]:
+        case "array":
+            return _decode_arrays(header["arrays"], buffers, shared_memory)[0]
+        case "arrays":
+            return tuple(_decode_arrays(header["arrays"], buffers, shared_memory))
+        case "joblib":
+            with BytesIO(buffers[0]) as io:
+                return joblib.load(io)  # nosec
+    raise ValueError(f"Unknown payload type: {header['payload']}")
+
+
+def _frombuffer(spec: dict, buffer: bytes | memoryview) -> np.ndarray:
+    array = np.frombuffer(buffer, dtype=np.dtype(spec["dtype"])).reshape(spec["shape"])
+    # Decrypted segments and asyncio reads are immutable bytes, copy them to be writable.
+    return array if array.flags.writeable else array.copy()
+
+
+def pack_frame(obj, secret: Key | None, blocks: List[str] | None = None) -> List:
+    """Packs an object into a binary frame and returns the buffers to send.
+
+    The frame is a preamble followed by encrypted segments: the first one is a
+    json header, the others are the payload buffers. Without a secret the
+    segments are sent as they are, for unix sockets only. With blocks large
+    arrays are passed in shared memory, see _encode_payload.
+    """
+    local = secret is None
+    encode = partial(_encode_payload, compress=not local, blocks=blocks)
+
+    with METRICS.timer("phase_seconds", phase="serialize"):
+        if isinstance(obj, Command) and isinstance(obj.uuid, UUID):
+            kind = KIND_COMMAND
+            header, buffers = encode(obj.payload)
+            header.update(name=obj.name, uuid=obj.uuid.hex)
+        elif isinstance(obj, Result) and isinstance(obj.uuid, UUID):
+            kind = KIND_RESULT
+            header, buffers = encode(obj.payload)
+            header.update(uuid=obj.uuid.hex)
+        else:
+            kind = KIND_OBJECT
+            header, buffers = {"payload": "joblib"}, [_dump(obj, not local)]
+
+        segments = [json.dumps(header).encode(), *buffers]
+
+    version = LOCAL_FRAME_VERSION if local else FRAME_VERSION
+    preamble = FRAME_PREAMBLE.pack(version, kind, len(segments), time.time())
+    frame = [preamble]
+
+    if secret is None:
+        for segment in segments:
+            frame += [SEGMENT_HEADER.pack(len(segment), bytes(NONCE_LENGTH)), segment]
+    else:
+        with METRICS.timer("phase_seconds", phase="encrypt"):
+            for index, segment in enumerate(segments):
+                nonce = os.urandom(NONCE_LENGTH)
+                aad = preamble + index.to_bytes(2, "big")
+                data = secret.aead.encrypt(nonce, segment, aad)
+                frame += [SEGMENT_HEADER.pack(len(data), nonce), data]
+
+    size = sum(len(part) for part in frame)
+    return [size.to_bytes(INT_LENGTH, "big"), *frame]
+
+
+def unpack_frame(data: memoryview, secret: Key | None, shared_memory=False) -> Any:
+    """Unpacks a binary frame created by pack_frame, without secret for local frames.
+
+    Arrays in shared memory are only accepted if shared_memory is set, which
+    requires a local frame.
+    """
+    if shared_memory and secret is not None:
+        raise ValueError("Shared memory is only accepted in local frames")
+
+    version, kind, count, timestamp = FRAME_PREAMBLE.unpack_from(data)
+    if version != (LOCAL_FRAME_VERSION if secret is None else FRAME_VERSION):
+        raise ValueError(f"Unknown frame version: {version}")
+
+    now = time.time()
+    if timestamp + FERNET_TTL < now or timestamp > now + MAX_CLOCK_SKEW:
+        raise InvalidToken
+
+    preamble = bytes(data[: FRAME_PREAMBLE.size])
+    offset = FRAME_PREAMBLE.size
+    segments: List[bytes | memoryview] = []
+
+    with METRICS.timer("phase_seconds", phase="decrypt"):
+        for index in range(count):
+            length, nonce = SEGMENT_HEADER.unpack_from(data, offset)
+            offset += SEGMENT_HEADER.size
+            segment: bytes | memoryview = data[offset : offset + length]
+            if secret is not None:
+                aad = preamble + index.to_bytes(2, "big")
+                segment = secret.aead.decrypt(nonce, segment, aad)
+            segments.append(segment)
+            offset += length
+
+    with METRICS.timer("phase_seconds", phase="deserialize"):
+        header = json.loads(bytes(segments[0]))
+        payload = _decode_payload(header, segments[1:], shared_memory)
+
+    if kind == KIND_COMMAND:
+        return Command(header["name"], UUID(header["uuid"]), payload)
+    if kind == KIND_RESULT:
+        return Result(payload, UUID(header["uuid"]))
+    return payload
+
+
+def unpack_obj(data: bytes | memoryview, secret: Key | None, local=False, shared_memory=False) -> Any:
+    """Unpacks an object received with any protocol.
+
+    Unencrypted frames are only accepted from local peers, which are
+    authenticated by the permissions of the unix socket. Arrays in shared
+    memory only in unencrypted frames of peers that negotiated it.
+    """
+    if data[:1] == bytes([FRAME_VERSION]):
+        return unpack_frame(memoryview(data), secret)
+
+    if data[:1] == bytes([LOCAL_FRAME_VERSION]):
+        if not local:
+            raise InvalidToken
+        return unpack_frame(memoryview(data), None, shared_memory)
+
+    if secret is None:
+        raise InvalidToken
+
+    with METRICS.timer("phase_seconds", phase="decrypt"):
+        decrypted = secret.decrypt(bytes(data), FERNET_TTL)
+
+    with METRICS.timer("phase_seconds", phase="deserialize"), BytesIO(decrypted) as io:
+        return joblib.load(io)  # nosec
+
+
+def _recv_exactly(reader: socket.socket, size: int) -> memoryview:
+    """Receive exactly size bytes into a single buffer."""
+    buffer = memoryview(bytearray(size))
+    received = 0
+
+    while received < size:
+        count = reader.recv_into(buffer[received:], size - received)
+        if count == 0:
+            raise ConnectionError("Connection closed while receiving data")
+        received += count
+
+    return buffer
+
+
+def _pack_frame(obj, secret: Key | None, protocol: int, blocks: List[str] | None = None) -> List:
+    if protocol >= PROTOCOL_SHARED_MEMORY:
+        return pack_frame(obj, None, [] if blocks is None else blocks)
+    if protocol >= PROTOCOL_LOCAL:
+        return pack_frame(obj, None)
+    return pack_frame(obj, secret)
+
+
+def _sendmsg_all(writer: socket.socket, buffers: List) -> None:
+    """Send all buffers with scatter/gather writes, without joining them first."""
+    views = [memoryview(buffer).cast("B") for buffer in buffers]
+
+    while views:
+        sent = writer.sendmsg(views)
+        while sent:
+            if sent >= len(views[0]):
+                sent -= len(views.pop(0))
+            else:
+                views[0] = views[0][sent:]
+                sent = 0
 
 
 def pack_obj(obj, secret: Fernet) -> Tuple[int, bytes]:
@@ -63,17 +419,35 @@ def pack_obj(obj, secret: Fernet) -> Tuple[int, bytes]:
     LOG.debug("Opening BytesIo object")
     with BytesIO() as io:
         LOG.debug("Dumping object with joblib")
-        joblib.dump(obj, io, compress=True)
+        with METRICS.timer("phase_seconds", phase="serialize"):
+            joblib.dump(obj, io, compress=True)
         LOG.debug("Seeking to start of io object")
         io.seek(0)
         LOG.debug("Encrypt io object")
-        data = secret.encrypt(io.getvalue())
+        with METRICS.timer("phase_seconds", phase="encrypt"):
+            data = secret.encrypt(io.getvalue())
     size = len(data)
     return size, data
 
 
-async def send_obj(writer: asyncio.StreamWriter, obj: Any, secret: Fernet) -> None:
+async def send_obj(
+    writer: asyncio.StreamWriter,
+    obj: Any,
+    secret: Key,
+    protocol: int = PROTOCOL_JOBLIB,
+) -> None:
     """Send object over the writer. first the size and after that the data."""
+    if protocol >= PROTOCOL_FRAMES:
+        blocks: List[str] = []
+        try:
+            writer.writelines(_pack_frame(obj, secret, protocol, blocks))
+            await writer.drain()
+        except OSError:
+            # The receiver would have unlinked the shared memory.
+            _unlink_shared_memory(blocks)
+            raise
+        return
+
     LOG.debug("Packing object with secret.")
     size, data = pack_obj(obj, secret)
 
@@ -85,8 +459,22 @@ async def send_obj(writer: asyncio.StreamWriter, obj: Any, secret: Fernet) -> No
     await writer.drain()
 
 
-def send_obj_sync(writer: socket.socket, obj: Any, secret: Fernet) -> None:
+def send_obj_sync(
+    writer: socket.socket,
+    obj: Any,
+    secret: Key,
+    protocol: int = PROTOCOL_JOBLIB,
+) -> None:
     """Sends an object to another socket synchronously."""
+    if protocol >= PROTOCOL_FRAMES:
+        blocks: List[str] = []
+        try:
+            _sendmsg_all(writer, _pack_frame(obj, secret, protocol, blocks))
+        except OSError:
+            _unlink_shared_memory(blocks)
+            raise
+        return
+
     (
         size,
         data,
@@ -96,7 +484,9 @@ def send_obj_sync(writer: socket.socket, obj: Any, secret: Fernet) -> None:
     writer.sendall(data)
 
 
-async def receive_obj(reader: asyncio.StreamReader, secret: Fernet) -> Any:
+async def receive_obj(
+    reader: asyncio.StreamReader, secret: Key | None, local=False, shared_memory=False
+) -> Any:
     """Receive an object over the reader."""
     try:
         size = int.from_bytes(await reader.readexactly(INT_LENGTH), "big")
@@ -109,18 +499,15 @@ async def receive_obj(reader: asyncio.StreamReader, secret: Fernet) -> Any:
 
     LOG.debug("Expecting %d bytes of data", size)
 
-    with BytesIO() as io:
-        data = secret.decrypt(await reader.readexactly(size), FERNET_TTL)
-        io.write(data)
-        io.seek(0)
-        LOG.debug("Received %d bytes of data", size)
-
-        obj = joblib.load(io)
+    data = await reader.readexactly(size)
+    LOG.debug("Received %d bytes of data", size)
 
-    return obj
+    return unpack_obj(data, secret, local, shared_memory)
 
 
-def receive_obj_sync(reader: socket.socket, secret: Fernet) -> Any:
+def receive_obj_sync(
+    reader: socket.socket, secret: Key | None, local=False, shared_memory=False
+) -> Any:
     """Receive an object over the socket synchronously."""
     size = int.from_bytes(reader.recv(INT_LENGTH, socket.MSG_WAITALL), "big")
 
@@ -129,22 +516,89 @@ def receive_obj_sync(reader: socket.socket, secret: Fernet) -> Any:
         return None
 
     LOG.info(f"Received: {size} bytes")
-    with BytesIO() as io:
-        data = secret.decrypt(reader.recv(size, socket.MSG_WAITALL), FERNET_TTL)
-        io.write(data)
-        io.seek(0)
-        obj = joblib.load(io)  # nosec
 
-    return obj
+    return unpack_obj(_recv_exactly(reader, size), secret, local, shared_memory)
+
+
+# Commands waiting to be written by the recorder, more are dropped.
+RECORD_QUEUE_SIZE = 10_000
+
+
+class Recorder:
+    """Appends received commands with their arrival time to a file, to replay them later.
+
+    Every record is the length followed by the compressed joblib dump of
+    (timestamp, command). The file holds the decrypted messages. Commands
+    are dumped and written by a background thread, off the event loop.
+    """
+
+    def __init__(self, path) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.queue: queue.Queue = queue.Queue(RECORD_QUEUE_SIZE)
+        self.thread: threading.Thread | None = None
+        self.pid: int | None = None
+        self.dropped = 0
+
+    def record(self, cmd: Command) -> None:
+        with self.lock:
+            # Started on first use, so forked workers have their own thread and file.
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.queue = queue.Queue(RECORD_QUEUE_SIZE)
+                self.thread = threading.Thread(target=self._write, daemon=True)
+                self.thread.start()
+
+        try:
+            self.queue.put_nowait((time.time(), cmd))
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self) -> None:
+        """Write the queued commands and stop the thread."""
+        if self.thread is not None and self.pid == os.getpid():
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = self.pid = None
+
+    def _write(self) -> None:
+        # Unbuffered, every record is a single write so records of processes
+        # sharing the file don't interleave.
+        with open(self.path, "ab", buffering=0) as fp:
+            while (record := self.queue.get()) is not None:
+                data = _dump(record)
+                fp.write(len(data).to_bytes(INT_LENGTH, "big") + data)
+
+
+def read_recording(path) -> Iterator[Tuple[float, Command]]:
+    """Yields the timestamps and commands written by a Recorder.
+
+    A truncated last record, of a recorder stopped while writing, is skipped.
+    """
+    with open(path, "rb") as fp:
+        while len(header := fp.read(INT_LENGTH)) == INT_LENGTH:
+            size = int.from_bytes(header, "big")
+            data = fp.read(size)
+            if len(data) < size:
+                LOG.warning("Skipped the truncated last record of %s", path)
+                return
+            with BytesIO(data) as io:
+                yield joblib.load(io)  # nosec
+
+
+# Commands received by the server are recorded if API_RECORD_PATH is set.
+RECORDER = Recorder(os.environ["API_RECORD_PATH"]) if os.environ.get("API_RECORD_PATH") else None
 
 
 async def receive_command(
-    reader: asyncio.StreamReader, secret: Fernet
+    reader: asyncio.StreamReader, secret: Key, local=False, shared_memory=False
 ) -> Command | None:
     """Waits for the sender to send a command object."""
-    cmd = await receive_obj(reader, secret)
+    cmd = await receive_obj(reader, secret, local, shared_memory)
 
     if isinstance(cmd, Command):
+        if RECORDER is not None:
+            RECORDER.record(cmd)
         return cmd
 
     if cmd is None:
@@ -154,28 +608,30 @@ async def receive_command(
 
 
 async def receive_result(
-    reader: asyncio.StreamReader, secret: Fernet
-) -> Result | Closed:
+    reader: asyncio.StreamReader, secret: Key | None, local=False, shared_memory=False
+) -> Result | ServerException | Closed:
     """Receive a result over the reader."""
-    result = await receive_obj(reader, secret)
+    result = await receive_obj(reader, secret, local, shared_memory)
 
     if result is None:
         return Closed()
 
-    if isinstance(result, Result):
+    if isinstance(result, (Result, ServerException, Closed)):
         return result
 
     raise Exception(f"Received unknown object: {result}")
 
 
-def receive_result_sync(reader: socket.socket, secret: Fernet) -> Result | Closed:
+def receive_result_sync(
+    reader: socket.socket, secret: Key | None, local=False, shared_memory=False
+) -> Result | ServerException | Closed:
     """Receive a result over the reader synchronously."""
-    result = receive_obj_sync(reader, secret)
+    result = receive_obj_sync(reader, secret, local, shared_memory)
 
     if result is None:
         return Closed()
 
-    if isinstance(result, Result) or isinstance(result, Closed):
+    if isinstance(result, (Result, ServerException, Closed)):
         return result
 
     if isinstance(result, Exception):
@@ -185,22 +641,30 @@ def receive_result_sync(reader: socket.socket, secret: Fernet) -> Result | Close
 
 
 async def send_command(
-    writer: asyncio.StreamWriter, cmd: Command, secret: Fernet
+    writer: asyncio.StreamWriter,
+    cmd: Command,
+    secret: Key,
+    protocol: int = PROTOCOL_JOBLIB,
 ) -> None:
     """Send the command over the writer."""
-    await send_obj(writer, cmd, secret)
+    await send_obj(writer, cmd, secret, protocol)
 
 
-def send_command_sync(writer: socket.socket, cmd: Command, secret: Fernet) -> None:
+def send_command_sync(
+    writer: socket.socket, cmd: Command, secret: Key, protocol: int = PROTOCOL_JOBLIB
+) -> None:
     """Send the command over the writer synchronously."""
-    send_obj_sync(writer, cmd, secret)
+    send_obj_sync(writer, cmd, secret, protocol)
 
 
 async def send_result(
-    writer: asyncio.StreamWriter, result: Closed | Result | Exception, secret: Fernet
+    writer: asyncio.StreamWriter,
+    result: Closed | Result | ServerException,
+    secret: Key,
+    protocol: int = PROTOCOL_JOBLIB,
 ) -> None:
     """Send the result over the writer."""
-    await send_obj(writer, result, secret)
+    await send_obj(writer, result, secret, protocol)
 
 
 async def send_close(writer: asyncio.StreamWriter) -> None:
@@ -0,0 +1,124 @@
+"""Sentence level encoding of documents."""
+import copy
+from dataclasses import dataclass
+from typing import Dict, List
+
+import numpy as np
+from document_embedding.base import DocumentEmbedding
+from document_embedding.sentences import split_into_sentences
+
+# Tokens per model call, sentences are padded to the longest one of their call.
+TOKEN_BUDGET = 8192
+
+
+@dataclass
+class Padding:
+    """Tokens encoded compared to the tokens of the padded model inputs."""
+
+    tokens: int = 0
+    padded: int = 0
+    batches: int = 0
+
+    def add(self, other: "Padding") -> None:
+        self.tokens += other.tokens
+        self.padded += other.padded
+        self.batches += other.batches
+
+    def stats(self) -> dict:
+        return {
+            "tokens": self.tokens,
+            "padded_tokens": self.padded,
+            "batches": self.batches,
+            "efficiency": self.tokens / self.padded if self.padded else 1.0,
+        }
+
+
+class _Lookup:
+    """Stands in for the sentence model and returns embeddings computed beforehand."""
+
+    def __init__(self, embeddings: Dict[str, np.ndarray]) -> None:
+        self.embeddings = embeddings
+
+    def encode(self, sentences: List[str]):
+        return np.array([self.embeddings[sentence] for sentence in sentences])
+
+
+def token_lengths(model, sentences: List[str]) -> List[int]:
+    """Number of tokens of the sentences as the model sees them, after truncation."""
+    encoded = model.tokenizer(
+        sentences,
+        truncation=True,
+        max_length=model.max_seq_length,
+        return_attention_mask=False,
+        return_token_type_ids=False,
+    )
+    return [len(ids) for ids in encoded["input_ids"]]
+
+
+def encode_sentences(
+    model, sentences: List[str], token_budget=TOKEN_BUDGET, padding: Padding | None = None
+) -> np.ndarray:
+    """Encode the sentences in buckets of similar length.
+
+    Sentences are sorted by their number of tokens and split into buckets
+    whose padded size stays within token_budget, each bucket is one model
+    call. The embeddings are returned in the order of sentences.
+    """
+    if not sentences:
+        return model.encode(sentences)
+
+    lengths = token_lengths(model, sentences)
+    order = np.argsort(lengths, kind="stable")
+
+    buckets: List[List[int]] = [[]]
+    for index in order:
+        # Sorted by length, so the new sentence is the longest of its bucket.
+        if buckets[-1] and (len(buckets[-1]) + 1) * lengths[index] > token_budget:
+            buckets.append([])
+        buckets[-1].append(index)
+
+    embeddings = []
+    for bucket in buckets:
+        embeddings.append(
+            model.encode([sentences[i] for i in bucket], batch_size=len(bucket))
+        )
+
+        if padding is not None:
+            padding.tokens += sum(lengths[i] for i in bucket)
+            padding.padded += len(bucket) * lengths[bucket[-1]]
+            padding.batches += 1
+
+    return np.concatenate(embeddings)[np.argsort(order)]
+
+
+def encode_documents(
+    encoder: DocumentEmbedding,
+    documents,
+    token_budget=TOKEN_BUDGET,
+    padding: Padding | None = None,
+) -> np.ndarray:
+    """Encode the documents like encoder.encode, but with as few model calls as possible.
+
+    DocumentEmbedding runs the sentence model once per document, here the
+    sentences of all documents are encoded together and looked up afterwards.
+    The embeddings have the shape encoder.encode returns, also for a single string.
+    Encoders other than a DocumentEmbedding are called as they are.
+    """
+    if not isinstance(encoder, DocumentEmbedding):
+        return encoder.encode(documents)
+
+    sentences = list(
+        dict.fromkeys(
+            sentence
+            for document in ([documents] if isinstance(documents, str) else documents)
+            for sentence in split_into_sentences(document, encoder.language)
+        )
+    )
+    embeddings = encode_sentences(encoder.model, sentences, token_budget, padding)
+
+    # A copy, the encoder is shared by the executor threads. DocumentEmbedding
+    # keeps its sentence model and language in the attributes it was created with.
+    lookup = copy.copy(encoder)
+    lookup.model = _Lookup(dict(zip(sentences, embeddings)))
+
+    return lookup.encode(documents)
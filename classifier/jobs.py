@@ -0,0 +1,241 @@
+"""Background training jobs of the classifier server."""
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from contextlib import suppress
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+from uuid import uuid4
+
+LOG = logging.getLogger("jobs")
+
+# Finished jobs kept around for status requests.
+HISTORY_SIZE = 100
+
+# Phases of jobs that will not change anymore.
+FINISHED_PHASES = ("done", "failed", "cancelled", "superseded")
+
+# Seconds between updates of the shared state of the running job.
+PUBLISH_INTERVAL = 0.5
+
+
+class JobCancelled(Exception):
+    pass
+
+
+@dataclass
+class TrainingJob:
+    key: str
+    payload: dict
+    total: int
+    id: str = field(default_factory=lambda: uuid4().hex)
+    phase: str = "queued"
+    embedded: int = 0
+    created: float = field(default_factory=time.time)
+    started: float | None = None
+    finished: float | None = None
+    error: str | None = None
+    cancel_requested: bool = False
+
+    @property
+    def done(self) -> bool:
+        return self.finished is not None
+
+    def check_cancelled(self) -> None:
+        """Called by the training between steps, raises if the job should stop."""
+        if self.cancel_requested:
+            raise JobCancelled()
+
+    def status(self) -> dict:
+        start = self.started or self.created
+        return {
+            "id": self.id,
+            "key": self.key,
+            "phase": self.phase,
+            "samples": self.total,
+            "embedded": self.embedded,
+            "elapsed": (self.finished or time.time()) - start,
+            "error": self.error,
+        }
+
+
+class SharedJobs:
+    """Status of the jobs of all workers of a server, in a directory they share.
+
+    With SO_REUSEPORT a status or cancel request can reach another worker
+    than the one running the job. Workers publish the status of their jobs
+    here and pick up cancel requests made through other workers.
+    """
+
+    def __init__(self, path) -> None:
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def publish(self, status: dict) -> None:
+        path = self._path(status["id"], "json")
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as fp:
+            json.dump(status, fp)
+        os.replace(tmp, path)
+
+    def status(self, job_id) -> dict | None:
+        try:
+            with open(self._path(job_id, "json")) as fp:
+                return json.load(fp)
+        except FileNotFoundError:
+            return None
+
+    def request_cancel(self, job_id) -> None:
+        open(self._path(job_id, "cancel"), "w").close()
+
+    def cancel_requested(self, job_id) -> bool:
+        return os.path.exists(self._path(job_id, "cancel"))
+
+    def remove(self, job_id) -> None:
+        for suffix in ("json", "cancel"):
+            with suppress(FileNotFoundError):
+                os.unlink(self._path(job_id, suffix))
+
+    def _path(self, job_id, suffix) -> str:
+        # Job ids come from clients, they must not point outside the directory.
+        return os.path.join(self.path, f"{os.path.basename(str(job_id))}.{suffix}")
+
+
+class JobQueue:
+    """Runs training jobs one after another in the background.
+
+    A new job for a key replaces a job for the same key that has not
+    started yet, so only the latest training request is executed. With
+    shared, jobs of other workers can be queried and cancelled too.
+    """
+
+    def __init__(
+        self, run: Callable[[TrainingJob], Awaitable[None]], shared: SharedJobs | None = None
+    ) -> None:
+        self.run = run
+        self.shared = shared
+        self.queued: OrderedDict[str, TrainingJob] = OrderedDict()
+        self.jobs: OrderedDict[str, TrainingJob] = OrderedDict()
+        self.running: TrainingJob | None = None
+        self.wakeup = asyncio.Event()
+        self.worker: asyncio.Task | None = None
+
+    def submit(self, key, payload: dict, total: int) -> TrainingJob:
+        job = TrainingJob(key, payload, total)
+
+        superseded = self.queued.pop(key, None)
+        if superseded is not None:
+            self._finish(superseded, "superseded")
+
+        self.queued[key] = job
+        self.jobs[job.id] = job
+        self._publish(job)
+        self.wakeup.set()
+
+        if self.worker is None:
+            self.worker = asyncio.create_task(self._work())
+
+        return job
+
+    def get(self, job_id) -> TrainingJob:
+        if job_id not in self.jobs:
+            raise KeyError(f"Unknown job: {job_id}")
+        return self.jobs[job_id]
+
+    def status(self, job_id) -> dict:
+        """Status of the job, of this worker or another one."""
+        if job_id not in self.jobs and self.shared is not None:
+            if (status := self.shared.status(job_id)) is not None:
+                return status
+        return self.get(job_id).status()
+
+    def cancel(self, job_id) -> dict:
+        """Cancel the job and return its status, jobs of other workers stop at their next step."""
+        if job_id not in self.jobs and self.shared is not None:
+            if (status := self.shared.status(job_id)) is not None:
+                if status["phase"] not in FINISHED_PHASES:
+                    self.shared.request_cancel(job_id)
+                return status
+
+        job = self.get(job_id)
+
+        if self.queued.get(job.key) is job:
+            del self.queued[job.key]
+            self._finish(job, "cancelled")
+        elif not job.done:
+            job.cancel_requested = True
+
+        return job.status()
+
+    def stats(self) -> dict:
+        return {
+            "queued": len(self.queued),
+            "running": self.running.status() if self.running else None,
+        }
+
+    async def _work(self) -> None:
+        while True:
+            if not self.queued:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            _, job = self.queued.popitem(last=False)
+            if self.shared is not None and self.shared.cancel_requested(job.id):
+                self._finish(job, "cancelled")
+                continue
+
+            self.running = job
+            job.started = time.time()
+            watcher = asyncio.create_task(self._watch(job)) if self.shared else None
+
+            try:
+                await self.run(job)
+            except JobCancelled:
+                self._finish(job, "cancelled")
+            except Exception as ex:
+                LOG.exception("Training of %s failed", job.key)
+                job.error = f"{type(ex).__name__}: {ex}"
+                self._finish(job, "failed")
+            else:
+                self._finish(job, "done")
+            finally:
+                self.running = None
+                if watcher is not None:
+                    watcher.cancel()
+
+    async def _watch(self, job: TrainingJob) -> None:
+        """Publish the progress of the running job and pick up cancel requests of other workers.
+
+        The state files are tiny, they are written on the event loop so no
+        update lands after the one of _finish.
+        """
+        assert self.shared is not None
+
+        while True:
+            if self.shared.cancel_requested(job.id):
+                job.cancel_requested = True
+            self._publish(job)
+            await asyncio.sleep(PUBLISH_INTERVAL)
+
+    def _publish(self, job: TrainingJob) -> None:
+        if self.shared is None:
+            return
+        try:
+            self.shared.publish(job.status())
+        except OSError:
+            LOG.exception("Could not publish the status of job %s", job.id)
+
+    def _finish(self, job: TrainingJob, phase: str) -> None:
+        job.phase = phase
+        job.finished = time.time()
+        self._publish(job)
+
+        finished = [job for job in self.jobs.values() if job.done]
+        for old in finished[: max(len(finished) - HISTORY_SIZE, 0)]:
+            del self.jobs[old.id]
+            if self.shared is not None:
+                self.shared.remove(old.id)
@@ -0,0 +1,61 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+
+from classifier import benchmark
+
+
+class Command(BaseCommand):
+    help = "Benchmark serialization, encryption and socket round trips of the wire protocols."
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "--case", action="append", choices=benchmark.CASES, help="Only run these cases."
+        )
+        parser.add_argument(
+            "--payload",
+            action="append",
+            choices=["short_string", "sentences_1k", "embeddings_10k", "training_set"],
+            help="Only use these payloads.",
+        )
+        parser.add_argument("--repeat", type=int, default=5)
+        parser.add_argument("--output", help="Write the results as JSON to this file.")
+        parser.add_argument(
+            "--compare", help="JSON results of an earlier run, fails if a case got slower."
+        )
+        parser.add_argument(
+            "--tolerance",
+            type=float,
+            default=0.2,
+            help="Slowdown relative to --compare that counts as a regression.",
+        )
+        return super().add_arguments(parser)
+
+    def handle(self, *args, **options):
+        results = benchmark.run(
+            options["case"] or benchmark.CASES, options["payload"], options["repeat"]
+        )
+        report = benchmark.report(results)
+
+        for result in report["results"]:
+            self.stdout.write(
+                f"{result['name']:<40} {result['seconds'] * 1e6:>12.1f}us "
+                f"{result['mb_per_s']:>10.1f}MB/s"
+            )
+
+        if options["output"]:
+            with open(options["output"], "w") as fp:
+                json.dump(report, fp, indent=2)
+        else:
+            self.stdout.write(json.dumps(report))
+
+        if options["compare"]:
+            with open(options["compare"]) as fp:
+                baseline = json.load(fp)
+
+            slower = benchmark.regressions(baseline, report, options["tolerance"])
+            if slower:
+                raise CommandError(
+                    "Slower than the baseline: "
+                    + ", ".join(f"{s['name']} ({s['ratio']:.2f}x)" for s in slower)
+                )
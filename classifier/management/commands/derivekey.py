@@ -0,0 +1,14 @@
+import base64
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from classifier.connection import derive_key
+
+
+class Command(BaseCommand):
+    help = "Print the derived key for API_SECRET, to be used as API_DERIVED_KEY."
+
+    def handle(self, *args, **options):
+        key = derive_key(settings.API_SECRET)
+        self.stdout.write(base64.urlsafe_b64encode(key).decode())
@@ -7,6 +7,12 @@ from classifier.server import main
 class Command(BaseCommand):
     def add_arguments(self, parser: CommandParser) -> None:
         parser.add_argument("host", nargs=1)
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Number of server processes sharing the model and the port.",
+        )
         return super().add_arguments(parser)
 
     def handle(self, *args, **options):
@@ -15,4 +21,5 @@ class Command(BaseCommand):
             host=options["host"][0],
             port=settings.API_PORT,
             path=settings.API_PATH,
+            workers=options["workers"],
         )
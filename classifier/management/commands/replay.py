@@ -0,0 +1,75 @@
+import asyncio
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandParser
+
+from classifier.replay import replay_recording
+
+
+class Command(BaseCommand):
+    help = "Replay commands recorded with API_RECORD_PATH and report their latencies."
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("recording")
+        parser.add_argument(
+            "--host",
+            help="Server to send the commands to, a server is started in this process if unset.",
+        )
+        parser.add_argument("--port", type=int, default=settings.API_PORT)
+        parser.add_argument(
+            "--allow-writes",
+            action="store_true",
+            help="Also send train and other commands that change classifiers to --host.",
+        )
+        parser.add_argument(
+            "--stub-encoder",
+            action="store_true",
+            help="Embed with a hash instead of the sentence model, nothing is downloaded.",
+        )
+        parser.add_argument(
+            "--speed",
+            type=float,
+            default=1.0,
+            help="Multiple of the recorded rate, 0 sends the commands as fast as possible.",
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=64,
+            help="Commands in flight when sending as fast as possible.",
+        )
+        return super().add_arguments(parser)
+
+    def handle(self, *args, **options):
+        report = asyncio.run(
+            replay_recording(
+                options["recording"],
+                settings.API_SECRET,
+                settings.API_DERIVED_KEY,
+                host=options["host"],
+                port=options["port"],
+                sbert_model=settings.SBERT_MODEL,
+                stub_encoder=options["stub_encoder"],
+                speed=options["speed"],
+                concurrency=options["concurrency"],
+                allow_writes=options["allow_writes"],
+            )
+        )
+        stats = report.stats()
+
+        self.stdout.write(
+            f"{sum(c['count'] for c in stats['commands'].values())} commands in "
+            f"{stats['elapsed']:.2f}s, {stats['throughput']:.1f} commands/s"
+        )
+        for name, count in stats["skipped"].items():
+            self.stdout.write(f"{name:>12}: {count} skipped, pass --allow-writes to send them")
+        for name, command in stats["commands"].items():
+            self.stdout.write(
+                f"{name:>12}: {command['count']} ok, {command['errors']} failed, "
+                f"p50 {command['p50_ms']:.1f}ms, p95 {command['p95_ms']:.1f}ms, "
+                f"p99 {command['p99_ms']:.1f}ms"
+            )
+
+        if options["verbosity"] > 1:
+            self.stdout.write(json.dumps(stats, indent=2))
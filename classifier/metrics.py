@@ -0,0 +1,165 @@
+"""Lightweight metrics for the classifier server."""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Tuple
+
+# Seconds, from a fraction of a millisecond for crypto to minutes for training.
+LATENCY_BOUNDS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300,
+)  # fmt: skip
+
+PREFIX = "classifier_"
+
+
+class Histogram:
+    """Counts observations per bucket, the last bucket holds everything above the bounds."""
+
+    def __init__(self, bounds: Iterable[float]) -> None:
+        self.bounds = tuple(sorted(bounds))
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self) -> dict:
+        labels = [str(bound) for bound in self.bounds] + ["+Inf"]
+        return {
+            "buckets": dict(zip(labels, self.counts)),
+            "sum": self.sum,
+            "count": self.count,
+        }
+
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: dict) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: Labels, **extra) -> str:
+    pairs = [*labels, *extra.items()]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+
+def _values(series: Dict[Labels, float]) -> List[dict]:
+    return [{"labels": dict(key), "value": value} for key, value in series.items()]
+
+
+class Metrics:
+    """Named counters, gauges and histograms with labels.
+
+    Gauges are either changed with add or read from a callback when the
+    metrics are read. The metrics are available as a dict for the stats
+    command and in the Prometheus text format.
+    """
+
+    def __init__(self) -> None:
+        self.counters: Dict[str, Dict[Labels, float]] = {}
+        self.gauges: Dict[str, Dict[Labels, float]] = {}
+        self.callbacks: Dict[str, Callable[[], float]] = {}
+        self.histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self.lock = threading.Lock()
+
+    def increment(self, name, value=1, **labels) -> None:
+        key = _labels(labels)
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def add(self, name, value, **labels) -> None:
+        """Change a gauge by value."""
+        key = _labels(labels)
+        with self.lock:
+            series = self.gauges.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def gauge(self, name, callback: Callable[[], float]) -> None:
+        """Register a gauge without labels that is read from callback."""
+        self.callbacks[name] = callback
+
+    def histogram(self, name, bounds=LATENCY_BOUNDS, **labels) -> Histogram:
+        """Return the histogram of name and labels, it is created on first use."""
+        key = _labels(labels)
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram(bounds)
+            return series[key]
+
+    def observe(self, name, value, **labels) -> None:
+        histogram = self.histogram(name, **labels)
+        with self.lock:
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observe the seconds spent in the block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            gauges = {name: _values(series) for name, series in self.gauges.items()}
+            for name, read in self.callbacks.items():
+                gauges[name] = [{"labels": {}, "value": read()}]
+
+            return {
+                "counters": {name: _values(series) for name, series in self.counters.items()},
+                "gauges": gauges,
+                "histograms": {
+                    name: [
+                        {"labels": dict(key), **histogram.snapshot()}
+                        for key, histogram in series.items()
+                    ]
+                    for name, series in self.histograms.items()
+                },
+            }
+
+    def render(self) -> str:
+        """The metrics in the Prometheus text format."""
+        lines: List[str] = []
+
+        with self.lock:
+            for name, series in self.counters.items():
+                lines.append(f"# TYPE {PREFIX}{name} counter")
+                for key, value in series.items():
+                    lines.append(f"{PREFIX}{name}{_format_labels(key)} {value}")
+
+            for name, series in self.gauges.items():
+                lines.append(f"# TYPE {PREFIX}{name} gauge")
+                for key, value in series.items():
+                    lines.append(f"{PREFIX}{name}{_format_labels(key)} {value}")
+
+            for name, read in self.callbacks.items():
+                lines.append(f"# TYPE {PREFIX}{name} gauge")
+                lines.append(f"{PREFIX}{name} {read()}")
+
+            for name, histograms in self.histograms.items():
+                lines.append(f"# TYPE {PREFIX}{name} histogram")
+                for key, histogram in histograms.items():
+                    cumulative = 0
+                    for bound, count in zip([*histogram.bounds, "+Inf"], histogram.counts):
+                        cumulative += count
+                        labels = _format_labels(key, le=bound)
+                        lines.append(f"{PREFIX}{name}_bucket{labels} {cumulative}")
+                    lines.append(f"{PREFIX}{name}_sum{_format_labels(key)} {histogram.sum}")
+                    lines.append(f"{PREFIX}{name}_count{_format_labels(key)} {histogram.count}")
+
+        return "\n".join(lines) + "\n"
+
+
+# Metrics of this process, shared by the server and the connection helpers.
+METRICS = Metrics()
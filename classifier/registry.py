@@ -0,0 +1,91 @@
+"""Sentence models of the server, loaded on first use."""
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict
+
+LOG = logging.getLogger("registry")
+
+
+def model_size(encoder) -> int:
+    """Bytes taken by the weights of the sentence model of the encoder."""
+    return sum(p.numel() * p.element_size() for p in encoder.model.parameters())
+
+
+class ModelRegistry:
+    """Encoders by model name, loaded lazily and bounded in memory.
+
+    The least recently used models are dropped once the loaded models take
+    more than max_bytes, the default model always stays loaded.
+    """
+
+    def __init__(self, load: Callable[[str], Any], default: str, max_bytes) -> None:
+        self.load = load
+        self.default = default
+        self.max_bytes = max_bytes
+
+        self.encoders: OrderedDict[str, Any] = OrderedDict()
+        self.sizes: Dict[str, int] = {}
+        self.lock = threading.Lock()
+        # One lock per model, so a model is only loaded once at a time.
+        self.loading: Dict[str, threading.Lock] = {}
+
+        self.loads = 0
+        self.evictions = 0
+
+    def resolve(self, name: str | None) -> str:
+        return name or self.default
+
+    def get(self, name: str | None = None):
+        """Return the encoder of the model, loading it if needed. Blocks while loading."""
+        name = self.resolve(name)
+
+        with self.lock:
+            if name in self.encoders:
+                self.encoders.move_to_end(name)
+                return self.encoders[name]
+            loading = self.loading.setdefault(name, threading.Lock())
+
+        with loading:
+            with self.lock:
+                if name in self.encoders:
+                    return self.encoders[name]
+
+            LOG.info("Loading model %s", name)
+            encoder = self.load(name)
+
+            with self.lock:
+                self.loads += 1
+                self.loading.pop(name, None)
+                self._insert(name, encoder)
+
+        return encoder
+
+    def put(self, name: str, encoder) -> None:
+        """Add an encoder that was loaded elsewhere."""
+        with self.lock:
+            self._insert(name, encoder)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "loaded": list(self.encoders),
+                "bytes": sum(self.sizes.values()),
+                "loads": self.loads,
+                "evictions": self.evictions,
+            }
+
+    def _insert(self, name: str, encoder) -> None:
+        self.encoders[name] = encoder
+        self.sizes[name] = model_size(encoder)
+
+        # Users of an evicted encoder keep their reference until they are done.
+        for key in list(self.encoders):
+            if sum(self.sizes.values()) <= self.max_bytes:
+                break
+            if key in (self.default, name):
+                continue
+            LOG.info("Unloading model %s", key)
+            del self.encoders[key]
+            del self.sizes[key]
+            self.evictions += 1
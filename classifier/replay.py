@@ -0,0 +1,196 @@
+"""Replay of recorded client traffic against a classifier server, see Recorder."""
+import asyncio
+import hashlib
+import logging
+import tempfile
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+from uuid import uuid4
+
+import numpy as np
+from document_embedding.pert import PertDocumentEmbedding
+
+from classifier.client import AsyncClient
+from classifier.connection import Command, CommandError, read_recording
+from classifier.server import Server
+
+LOG = logging.getLogger("replay")
+
+# Commands of the connection itself, the replay client sends its own.
+SKIPPED_COMMANDS = ("connect", "close")
+
+# Commands that change the classifiers of the server. training_set is the
+# first half of an incremental update, it is skipped together with train.
+WRITE_COMMANDS = ("train", "training_set", "cancel_job", "reload")
+
+STUB_DIMENSIONS = 384
+
+
+class StubSentenceModel:
+    """Stands in for the sentence model, sentences are embedded by their hash."""
+
+    max_seq_length = 128
+
+    def __init__(self, dimensions=STUB_DIMENSIONS) -> None:
+        self.dimensions = dimensions
+
+    def tokenizer(self, sentences, max_length=None, **kwargs):
+        max_length = max_length or self.max_seq_length
+        return {"input_ids": [sentence.split()[:max_length] for sentence in sentences]}
+
+    def encode(self, sentences, batch_size=32, **kwargs) -> np.ndarray:
+        embeddings = np.empty((len(sentences), self.dimensions), dtype=np.float32)
+
+        for i, sentence in enumerate(sentences):
+            seed = hashlib.blake2b(sentence.encode(), digest_size=8).digest()
+            rng = np.random.default_rng(int.from_bytes(seed, "big"))
+            embeddings[i] = rng.standard_normal(self.dimensions, dtype=np.float32)
+
+        return embeddings
+
+    def parameters(self):
+        return []
+
+
+def load_stub_encoder(_model_name) -> PertDocumentEmbedding:
+    return PertDocumentEmbedding(StubSentenceModel())
+
+
+@dataclass
+class Report:
+    """Latencies of the replayed commands by command name."""
+
+    latencies: Dict[str, List[float]] = field(default_factory=lambda: defaultdict(list))
+    errors: Dict[str, int] = field(default_factory=lambda: defaultdict(int))
+    skipped: Dict[str, int] = field(default_factory=lambda: defaultdict(int))
+    elapsed: float = 0.0
+
+    def stats(self) -> dict:
+        commands = {}
+
+        for name in sorted({*self.latencies, *self.errors}):
+            latencies = self.latencies[name]
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) if latencies else [0] * 3
+            commands[name] = {
+                "count": len(latencies),
+                "errors": self.errors[name],
+                "p50_ms": float(p50) * 1000,
+                "p95_ms": float(p95) * 1000,
+                "p99_ms": float(p99) * 1000,
+            }
+
+        completed = sum(len(latencies) for latencies in self.latencies.values())
+        return {
+            "elapsed": self.elapsed,
+            "throughput": completed / self.elapsed if self.elapsed else 0.0,
+            "commands": commands,
+            "skipped": dict(self.skipped),
+        }
+
+
+async def replay(
+    commands: List[Tuple[float, Command]],
+    client: AsyncClient,
+    speed=1.0,
+    concurrency=64,
+    allow_writes=True,
+) -> Report:
+    """Send the commands with the client, at their recorded rate times speed.
+
+    With speed 0 the commands are sent as fast as possible, with at most
+    concurrency commands in flight. Without allow_writes, commands that
+    change the classifiers are skipped.
+    """
+    report = Report()
+    limit = asyncio.Semaphore(concurrency)
+    tasks = []
+
+    async def send(cmd: Command):
+        started = time.perf_counter()
+        try:
+            await client.send_command(Command(cmd.name, uuid4(), cmd.payload))
+        except CommandError as ex:
+            LOG.debug("%s failed: %s", cmd.name, ex)
+            report.errors[cmd.name] += 1
+        else:
+            report.latencies[cmd.name].append(time.perf_counter() - started)
+
+    async def send_limited(cmd: Command):
+        async with limit:
+            await send(cmd)
+
+    skipped: Tuple[str, ...] = SKIPPED_COMMANDS
+    if not allow_writes:
+        skipped += WRITE_COMMANDS
+        for _, cmd in commands:
+            if cmd.name in WRITE_COMMANDS:
+                report.skipped[cmd.name] += 1
+
+    commands = [(ts, cmd) for ts, cmd in commands if cmd.name not in skipped]
+    if not commands:
+        return report
+
+    first = commands[0][0]
+    start = time.perf_counter()
+
+    for timestamp, cmd in commands:
+        if not speed:
+            tasks.append(asyncio.create_task(send_limited(cmd)))
+            continue
+
+        # Keep the recorded rate, however many commands are in flight.
+        delay = start + (timestamp - first) / speed - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(send(cmd)))
+
+    await asyncio.gather(*tasks)
+    report.elapsed = time.perf_counter() - start
+    return report
+
+
+async def replay_recording(
+    path,
+    secret,
+    derived_key=None,
+    host=None,
+    port=None,
+    sbert_model=None,
+    stub_encoder=False,
+    speed=1.0,
+    concurrency=64,
+    allow_writes=False,
+) -> Report:
+    """Replay a recording against the server at host and port.
+
+    Without host a server is started in this process, on a temporary store
+    so the classifiers of the recording don't mix with real ones. Commands
+    that change the classifiers are only sent to a server at host with
+    allow_writes.
+    """
+    commands = list(read_recording(path))
+
+    async def run(host, port, allow_writes) -> Report:
+        client = AsyncClient(host, port, secret, derived_key)
+        await client.connect()
+        try:
+            return await replay(commands, client, speed, concurrency, allow_writes)
+        finally:
+            await client.disconnect()
+
+    if host is not None:
+        return await run(host, port, allow_writes)
+
+    with tempfile.TemporaryDirectory() as directory:
+        args = (sbert_model, directory, secret, 0, "127.0.0.1", derived_key)
+        server = Server(*args, load_encoder=load_stub_encoder) if stub_encoder else Server(*args)
+        serving = asyncio.create_task(server.start())
+        await server.serving.wait()
+
+        try:
+            return await run("127.0.0.1", server.server.sockets[0].getsockname()[1], True)
+        finally:
+            server.stop()
+            await serving
@@ -1,123 +1,670 @@
 import asyncio
+import logging
 import os
 import signal
+import socket
+import stat
+import time
 import traceback
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
 from functools import partial
+from typing import Callable, Dict, List, Set, Tuple
 
-import joblib
+import numpy as np
 from document_embedding.pert import PertDocumentEmbedding
 from sentence_transformers import SentenceTransformer
 from sklearn.svm import SVC
 
+from classifier.batching import BATCH_SIZE_BOUNDS, Batcher
+from classifier.cache import EmbeddingCache
 from classifier.connection import (
+    LOCAL_PROTOCOLS,
+    OVERLOADED,
+    PROTOCOL_JOBLIB,
+    PROTOCOL_LOCAL,
+    PROTOCOL_SHARED_MEMORY,
+    PROTOCOLS,
+    RECORDER,
     Closed,
     Command,
     Result,
+    ServerException,
+    compact_embeddings,
     gen_key,
+    negotiate_protocol,
     receive_command,
+    sample_digest,
     send_result,
 )
+from classifier.encoding import TOKEN_BUDGET, Padding, encode_documents
+from classifier.jobs import JobQueue, SharedJobs, TrainingJob
+from classifier.metrics import METRICS
+from classifier.registry import ModelRegistry
+from classifier.store import ClassifierCache, TrainingSet, open_store
 
+LOG = logging.getLogger("server")
 
-def _load_classifiers(path):
-    return joblib.load(path)
+# Samples encoded at once while training, progress is reported per chunk.
+TRAIN_CHUNK_SIZE = 256
 
+# Commands that count against the in-flight limit, the others are cheap.
+LIMITED_COMMANDS = ("embedding", "predict", "train")
 
-def _store_classifiers(path, classifiers):
-    return
-    joblib.dump(classifiers, path)
+# Seconds before a crashed worker is restarted, doubled while it keeps
+# crashing within WORKER_STABLE_UPTIME of its start.
+WORKER_RESTART_DELAY = 1.0
+WORKER_RESTART_MAX_DELAY = 60.0
+WORKER_STABLE_UPTIME = 30.0
 
 
-class Server:
-    def __init__(self, sbert_model, path, secret, port=9090, host="0.0.0.0") -> None:
-        model = SentenceTransformer(sbert_model)
-        self.sbert_model = PertDocumentEmbedding(model)
+@dataclass
+class Connection:
+    """State of a single client connection, commands on it are processed concurrently."""
+
+    writer: asyncio.StreamWriter
+    protocol: int = PROTOCOL_JOBLIB
+    # Connected through the unix socket, the peer is trusted and may use the local protocols.
+    local: bool = False
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    pending: Set[asyncio.Task] = field(default_factory=set)
+
+    @property
+    def shared_memory(self) -> bool:
+        """Whether arrays in shared memory are accepted from the peer."""
+        return self.local and self.protocol == PROTOCOL_SHARED_MEMORY
+
+
+# Models of executor processes, see _init_worker.
+_models: ModelRegistry | None = None
+
+
+def _load_encoder(sbert_model) -> PertDocumentEmbedding:
+    return PertDocumentEmbedding(SentenceTransformer(sbert_model))
+
+
+def _init_worker(sbert_model, model_memory):
+    global _models
+    _models = ModelRegistry(_load_encoder, sbert_model, model_memory)
+    _models.get()
+
+
+def _encode_with(models: ModelRegistry, model, sentences, token_budget):
+    """Encode the sentences, returns the embeddings and the padding of the model calls."""
+    padding = Padding()
+    embeddings = encode_documents(models.get(model), sentences, token_budget, padding)
+    return embeddings, padding
+
+
+def _encode(model, sentences, token_budget):
+    """Encode the sentences with the models of the executor process."""
+    assert _models is not None
+    return _encode_with(_models, model, sentences, token_budget)
+
+
+def _timed(func, *args):
+    """Run func on an executor, returns when it started, how long it took and its result."""
+    started = time.monotonic()
+    result = func(*args)
+    return started, time.monotonic() - started, result
 
-        self.path = path
 
-        if os.path.exists(path):
-            self.classifiers = _load_classifiers(path)
+def _fit(embeddings, labels) -> SVC:
+    model = SVC()
+    model.fit(embeddings, labels)
+    return model
+
+
+def _create_executor(kind, workers, sbert_model, model_memory) -> Executor:
+    match kind:
+        case "thread":
+            return ThreadPoolExecutor(workers)
+        case "process":
+            return ProcessPoolExecutor(
+                workers, initializer=_init_worker, initargs=(sbert_model, model_memory)
+            )
+    raise ValueError(f"Unknown executor: {kind}")
+
+
+class Server:
+    def __init__(
+        self,
+        sbert_model,
+        path,
+        secret,
+        port=9090,
+        host="0.0.0.0",
+        derived_key=None,
+        executor="thread",
+        executor_workers=2,
+        batch_window=0.005,
+        batch_size=64,
+        token_budget=TOKEN_BUDGET,
+        cache_size=256 << 20,
+        cache_path=None,
+        cache_disk_size=1 << 30,
+        classifier_memory=1 << 30,
+        model_memory=4 << 30,
+        max_in_flight=256,
+        queue_timeout=30.0,
+        encoder=None,
+        load_encoder=_load_encoder,
+        reuse_port=False,
+        reload_interval=0,
+        metrics_port=None,
+        unix_socket: socket.socket | None = None,
+    ) -> None:
+        # Encoding, prediction and training run on executors, so the event loop
+        # stays responsive. Training gets its own executor and never delays
+        # the encodes of embedding and predict commands.
+        self.executor = _create_executor(
+            executor, executor_workers, sbert_model, model_memory
+        )
+        self.train_executor = _create_executor(executor, 1, sbert_model, model_memory)
+
+        # Models other than sbert_model are loaded on first use, by the executor
+        # that needs them.
+        self.models = ModelRegistry(load_encoder, sbert_model, model_memory)
+
+        self.encode: Callable[[str, List[str], int], Tuple[np.ndarray, Padding]]
+        if executor == "thread":
+            # A preloaded encoder is shared by forked workers, see serve_workers.
+            self.models.put(sbert_model, encoder or load_encoder(sbert_model))
+            self.encode = partial(_encode_with, self.models)
         else:
-            self.classifiers = dict()
+            self.encode = _encode
+
+        # Embedding and predict requests from all connections are encoded
+        # together, in one batch per model.
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+        self.batchers: Dict[str, Batcher] = {}
+        self.token_budget = token_budget
+        self.padding = Padding()
+        self.cache = EmbeddingCache(cache_size, cache_path, cache_disk_size)
+
+        self.path = path
+        self.store = open_store(path)
+        # Loaded on first use, cold classifiers are dropped to stay in the memory budget.
+        self.classifiers = ClassifierCache(self.store, classifier_memory)
+        # Workers sharing a port share their job states, a status request
+        # may reach another worker than the one running the job.
+        shared = SharedJobs(os.path.join(self.store.path, "jobs")) if reuse_port else None
+        self.jobs = JobQueue(self.run_training, shared)
+        self.writers: Set[asyncio.StreamWriter] = set()
+
+        # Admission control: commands beyond max_in_flight wait for a slot and
+        # are dropped if they don't get one within queue_timeout seconds, so
+        # clients back off before their messages expire. At most max_in_flight
+        # commands wait, further ones are rejected straight away.
+        self.max_in_flight = max_in_flight
+        self.queue_timeout = queue_timeout or None
+        self.slots = asyncio.Semaphore(max_in_flight)
+        self.in_flight = 0
+        self.waiting = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+        self.metrics_port = metrics_port
+        METRICS.gauge("connections", lambda: len(self.writers))
+        METRICS.gauge("admitted_in_flight", lambda: self.in_flight)
+        METRICS.gauge("admission_waiting", lambda: self.waiting)
+        METRICS.gauge("embedding_cache_bytes", lambda: self.cache.size)
+        METRICS.gauge("loaded_classifiers_bytes", lambda: self.classifiers.size)
 
         self.port = port
         self.host = host
-        self.secret = gen_key(secret)
-
-    def process_command(self, cmd: Command):
+        self.reuse_port = reuse_port
+        self.reload_interval = reload_interval
+        # Co-located clients connect through the unix socket, file permissions
+        # guard it instead of the secret.
+        self.unix_socket = unix_socket
+        self.secret = gen_key(secret, derived_key)
+        # Set once the server accepts connections.
+        self.serving = asyncio.Event()
+
+    async def process_command(self, cmd: Command, local=False):
         match cmd.name:
             case "train":
-                self.train_classifier(
+                job = self.train_classifier(
                     cmd.payload["key"],
                     cmd.payload["samples"],
                     cmd.payload["labels"],
+                    cmd.payload.get("ids"),
+                    cmd.payload.get("removed"),
+                    cmd.payload.get("model"),
+                )
+                return Result(job.status(), cmd.uuid)
+
+            case "training_set":
+                training_set = await self.load_training_set(
+                    cmd.payload["key"], cmd.payload.get("model")
+                )
+                digests = training_set.digest_map() if training_set else {}
+                return Result(digests, cmd.uuid)
+
+            case "reload":
+                reloaded = await asyncio.get_running_loop().run_in_executor(
+                    None, partial(self.classifiers.refresh, force=True)
                 )
-                return Result("done", cmd.uuid)
+                versions = {key: self.store.version(key) for key in self.store.keys()}
+                return Result({"reloaded": reloaded, "versions": versions}, cmd.uuid)
+
+            case "job_status":
+                return Result(self.jobs.status(cmd.payload["job"]), cmd.uuid)
+
+            case "cancel_job":
+                return Result(self.jobs.cancel(cmd.payload["job"]), cmd.uuid)
 
             case "embedding":
-                embedding = self.get_embedding(cmd.payload["sentence"])
+                embedding = await self.get_embedding(
+                    cmd.payload["sentence"], cmd.payload.get("model")
+                )
+                if "dtype" in cmd.payload:
+                    embedding = compact_embeddings(embedding, cmd.payload["dtype"])
                 return Result(embedding, cmd.uuid)
             case "predict":
-                prediction = self.predict_class(
+                prediction = await self.predict_class(
                     cmd.payload["key"], cmd.payload["sentences"]
                 )
                 return Result(prediction, cmd.uuid)
 
             case "connect":
-                return Result("success", cmd.uuid)
+                protocol = negotiate_protocol(
+                    (cmd.payload or {}).get("protocols"),
+                    LOCAL_PROTOCOLS if local else PROTOCOLS,
+                )
+                return Result({"status": "success", "protocol": protocol}, cmd.uuid)
 
             case "close":
                 return Closed()
 
             case "ping":
                 return Result("pong", cmd.uuid)
+
+            case "stats":
+                return Result(self.stats(), cmd.uuid)
         raise ValueError(f"Unknown command: {cmd.name}")
 
-    async def receive(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
-        cmd = await receive_command(reader, self.secret)
+    async def receive(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, local=False
+    ):
+        if local:
+            connection = Connection(writer, PROTOCOL_LOCAL, local=True)
+        else:
+            connection = Connection(writer)
+        self.writers.add(writer)
+        try:
+            await self.handle(reader, connection)
+        finally:
+            self.writers.discard(writer)
+
+    async def handle(self, reader: asyncio.StreamReader, connection: Connection):
+        writer = connection.writer
+        cmd = await receive_command(
+            reader, self.secret, connection.local, connection.shared_memory
+        )
 
         while cmd is not None:
+            match cmd.name:
+                case "connect":
+                    # Handled in order, later commands use the negotiated protocol.
+                    await self.execute(connection, cmd)
+                case "close":
+                    await asyncio.gather(*connection.pending, return_exceptions=True)
+                    await self.execute(connection, cmd)
+                    writer.close()
+                    break
+                case _:
+                    task = asyncio.create_task(self.execute(connection, cmd))
+                    connection.pending.add(task)
+                    task.add_done_callback(connection.pending.discard)
+
+            cmd = await receive_command(
+                reader, self.secret, connection.local, connection.shared_memory
+            )
+
+        await asyncio.gather(*connection.pending, return_exceptions=True)
+
+    async def execute(self, connection: Connection, cmd: Command):
+        """Process a single command and send its result, tagged with the uuid of the command."""
+        start = time.perf_counter()
+        METRICS.add("commands_in_flight", 1, command=cmd.name)
+
+        try:
+            result = await self.admit(cmd, connection.local)
+        except Exception as ex:
+            traceback.print_exc()
+            result = ServerException(f"{type(ex).__name__}: {ex}", cmd.uuid)
+        finally:
+            METRICS.add("commands_in_flight", -1, command=cmd.name)
+
+        match result:
+            case ServerException(code=str(code)):
+                status = code
+            case ServerException():
+                status = "error"
+            case _:
+                status = "ok"
+        METRICS.increment("commands_total", command=cmd.name, status=status)
+        METRICS.observe("command_seconds", time.perf_counter() - start, command=cmd.name)
+
+        if cmd.name == "connect" and isinstance(result, Result):
+            connection.protocol = result.payload["protocol"]
+
+        try:
+            async with connection.lock:
+                await send_result(connection.writer, result, self.secret, connection.protocol)
+        except ConnectionError:
+            LOG.warning("Connection lost before sending the result of %s", cmd.name)
+
+    async def admit(self, cmd: Command, local=False):
+        """Process the command once the server has capacity for it.
+
+        Only the wait for capacity is bounded by the queue deadline, an
+        admitted command runs to completion.
+        """
+        if cmd.name not in LIMITED_COMMANDS:
+            return await self.process_command(cmd, local)
+
+        if not self.slots.locked():
+            await self.slots.acquire()
+        elif self.waiting >= self.max_in_flight:
+            self.rejected += 1
+            return ServerException(
+                "Overloaded: too many commands waiting", cmd.uuid, OVERLOADED
+            )
+        else:
+            self.waiting += 1
             try:
-                result = self.process_command(cmd)
-                if result is not None:
-                    await send_result(writer, result, self.secret)
+                await asyncio.wait_for(self.slots.acquire(), self.queue_timeout)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                LOG.warning("Dropped %s command after waiting %ss", cmd.name, self.queue_timeout)
+                return ServerException("Overloaded: deadline exceeded", cmd.uuid, OVERLOADED)
+            finally:
+                self.waiting -= 1
+
+        self.in_flight += 1
+        try:
+            return await self.process_command(cmd, local)
+        finally:
+            self.in_flight -= 1
+            self.slots.release()
 
-                if isinstance(result, Closed):
-                    writer.close()
+    async def start(self):
+        self.server = await asyncio.start_server(
+            self.receive, self.host, self.port, reuse_port=self.reuse_port
+        )
 
-            except Exception as ex:
-                traceback.print_exc()
-                await send_result(writer, ex, self.secret)
-            cmd = await receive_command(reader, self.secret)
+        if self.reload_interval:
+            self.watcher = asyncio.create_task(self.watch_store())
 
-    async def start(self):
-        self.server = await asyncio.start_server(self.receive, self.host, self.port)
+        if self.metrics_port:
+            self.metrics_server = await asyncio.start_server(
+                self.serve_metrics, self.host, self.metrics_port
+            )
+
+        if self.unix_socket:
+            self.unix_server = await asyncio.start_unix_server(
+                partial(self.receive, local=True), sock=self.unix_socket
+            )
 
         async with self.server:
             await self.server.start_serving()
+            self.serving.set()
             await self.server.wait_closed()
 
-    def stop(self):
-        self.save()
-        self.server.close()
+    async def serve_metrics(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Answer any HTTP request with the metrics in the Prometheus text format."""
+        try:
+            await reader.readuntil(b"\r\n\r\n")
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            writer.close()
+            return
+
+        body = METRICS.render().encode()
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/plain; version=0.0.4\r\n"
+            b"Content-Length: %d\r\n"
+            b"Connection: close\r\n\r\n" % len(body)
+        )
+        writer.write(body)
+        await writer.drain()
+        writer.close()
+
+    async def run_timed(self, executor: Executor | None, phase, func, *args):
+        """Run func on the executor, the time it waited and ran are recorded as phases."""
+        loop = asyncio.get_running_loop()
+        submitted = time.monotonic()
+
+        started, elapsed, result = await loop.run_in_executor(executor, _timed, func, *args)
+
+        METRICS.observe("phase_seconds", started - submitted, phase="queue_wait")
+        METRICS.observe("phase_seconds", elapsed, phase=phase)
+        return result
 
-    def save(self):
-        _store_classifiers(self.path, self.classifiers)
+    async def watch_store(self):
+        """Pick up classifiers saved by other processes sharing the store or exported offline."""
+        loop = asyncio.get_running_loop()
 
-    def predict_class(self, key, values):
-        embedding = self.get_embedding(values)
-        result = self.classifiers[key].predict(embedding)
-        return result
+        while True:
+            await asyncio.sleep(self.reload_interval)
 
-    def get_embedding(self, sentence):
-        return self.sbert_model.encode(sentence)
+            try:
+                reloaded = await loop.run_in_executor(None, self.classifiers.refresh)
+            except Exception:
+                LOG.exception("Could not refresh the classifiers")
+                continue
 
-    def train_classifier(self, key, samples, labels):
-        embeddings = self.get_embedding(samples)
+            if reloaded:
+                LOG.info("Reloaded classifiers: %s", ", ".join(reloaded))
 
-        model = SVC()
-        model.fit(embeddings, labels)
-        self.classifiers[key] = model
+    def stop(self):
+        self.cache.close()
+        self.server.close()
+        if self.metrics_port:
+            self.metrics_server.close()
+        if self.unix_socket:
+            self.unix_server.close()
+        # The server only finishes closing once its connections are gone.
+        for writer in self.writers:
+            writer.close()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.train_executor.shutdown(wait=False, cancel_futures=True)
+        if RECORDER is not None:
+            RECORDER.close()
+
+    async def predict_class(self, key, values):
+        loop = asyncio.get_running_loop()
+
+        # Keep the current model, a concurrent retrain swaps in a new one.
+        classifier = self.classifiers.get(key)
+        if classifier is None:
+            classifier = await loop.run_in_executor(None, self.classifiers.load, key)
+        assert classifier is not None
+
+        embedding = await self.get_embedding(values, self.store.model(key))
+
+        # Prediction is cheap compared to the encoding and would need to ship
+        # the classifier to a worker process, so it runs on the default threads.
+        return await self.run_timed(None, "predict", classifier.predict, embedding)
+
+    async def get_embedding(self, sentence, model=None):
+        model = self.models.resolve(model)
+        return await self.encode_cached(sentence, self.batcher(model).encode, model)
+
+    def batcher(self, model) -> Batcher:
+        if model not in self.batchers:
+            self.batchers[model] = Batcher(
+                partial(self.run_encode, model),
+                self.batch_window,
+                self.batch_size,
+                METRICS.histogram("batch_documents", BATCH_SIZE_BOUNDS, model=model),
+            )
+        return self.batchers[model]
+
+    async def encode_cached(self, documents, encode, model):
+        """Encode the documents, only the ones missing in the cache are passed to encode."""
+        if isinstance(documents, str):
+            documents = [documents]
+        else:
+            documents = list(documents)
+
+        if not documents:
+            return await encode(documents)
+
+        cached = [self.cache.get(document, model) for document in documents]
+        missing = list(
+            dict.fromkeys(
+                document for document, embedding in zip(documents, cached) if embedding is None
+            )
+        )
+
+        encoded: Dict[str, np.ndarray] = {}
+        if missing:
+            encoded = dict(zip(missing, await encode(missing)))
+
+            for document, embedding in encoded.items():
+                self.cache.put(document, embedding, model)
+
+        embeddings = [
+            encoded[document] if embedding is None else embedding
+            for document, embedding in zip(documents, cached)
+        ]
+        return np.stack(embeddings)
+
+    async def run_encode(self, model, sentences, executor: Executor | None = None):
+        embeddings, padding = await self.run_timed(
+            executor or self.executor,
+            "encode",
+            self.encode,
+            model,
+            sentences,
+            self.token_budget,
+        )
+        self.padding.add(padding)
+        return embeddings
+
+    async def load_training_set(self, key, model=None) -> TrainingSet | None:
+        """Return the training set of the classifier, if it was embedded with the model."""
+        if self.models.resolve(model) != self.models.resolve(self.store.model(key)):
+            return None
+        # Unpickling the embeddings takes a while for large training sets.
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.store.load_training_set, key)
+
+    def train_classifier(
+        self, key, samples, labels, ids=None, removed=None, model=None
+    ) -> TrainingJob:
+        """Queue the training of a classifier, it runs in the background.
+
+        Without removed, the samples replace the training set. With removed,
+        the training is incremental: the samples identified by removed are
+        dropped, the given ones are added and only those are embedded.
+        """
+        payload = {
+            "samples": samples,
+            "labels": labels,
+            "ids": ids,
+            "removed": removed,
+            "model": self.models.resolve(model),
+        }
+        return self.jobs.submit(key, payload, len(samples))
+
+    async def run_training(self, job: TrainingJob):
+        loop = asyncio.get_running_loop()
+        samples, labels = job.payload["samples"], job.payload["labels"]
+        ids = job.payload["ids"] or range(len(samples))
+        model = job.payload["model"]
+
+        # The version the job builds on, the save fails if another process
+        # saved the classifier meanwhile, instead of persisting an older model.
+        base_version = await loop.run_in_executor(None, self.store.latest_version, job.key)
+
+        training_set = None
+        if job.payload["removed"] is not None:
+            training_set = await self.load_training_set(job.key, model)
+        if training_set is None:
+            training_set = TrainingSet()
+        training_set.remove(job.payload["removed"] or [])
+
+        # Training sets are large already, they bypass the batcher. They are
+        # encoded in chunks to report progress and allow cancellation.
+        job.phase = "embedding"
+        encode = partial(self.run_encode, model, executor=self.train_executor)
+        chunks = []
+
+        for start in range(0, len(samples), TRAIN_CHUNK_SIZE):
+            job.check_cancelled()
+            chunk = samples[start : start + TRAIN_CHUNK_SIZE]
+            chunks.append(await self.encode_cached(chunk, encode, model))
+            job.embedded += len(chunk)
+
+        if chunks:
+            training_set.add(
+                ids,
+                map(sample_digest, samples, labels),
+                labels,
+                np.concatenate(chunks),
+            )
+
+        if not len(training_set):
+            raise ValueError(f"No samples left to train {job.key}, it keeps the last version")
+
+        # The SVC has no partial fit, but refitting on the stored embeddings
+        # is cheap compared to encoding every sample again.
+        job.check_cancelled()
+        job.phase = "fitting"
+        classifier = await self.run_timed(
+            self.train_executor, "fit", _fit, training_set.embeddings, training_set.labels
+        )
+
+        job.check_cancelled()
+        job.phase = "saving"
+        version = await loop.run_in_executor(
+            None, self.store.save, job.key, classifier, training_set, model, base_version
+        )
+
+        self.classifiers.put(job.key, classifier, version)
+
+    def stats(self) -> dict:
+        return {
+            "batch_size": {
+                model: batcher.sizes.snapshot() for model, batcher in self.batchers.items()
+            },
+            "cache": self.cache.stats(),
+            "classifiers": self.classifiers.stats(),
+            "jobs": self.jobs.stats(),
+            "models": self.models.stats(),
+            "padding": self.padding.stats(),
+            "metrics": METRICS.snapshot(),
+            "admission": {
+                "in_flight": self.in_flight,
+                "waiting": self.waiting,
+                "max_in_flight": self.max_in_flight,
+                "rejected": self.rejected,
+                "timeouts": self.timeouts,
+            },
+        }
+
+
+def bind_unix_socket(path, mode=0o660) -> socket.socket:
+    """Listen on a unix socket at path, only users with access to the file may connect."""
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            # Left behind by a server that did not shut down cleanly.
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    os.chmod(path, mode)
+    sock.listen(socket.SOMAXCONN)
+    sock.setblocking(False)
+    return sock
 
 
 def stop(server: Server, _signum):
@@ -125,11 +672,11 @@ def stop(server: Server, _signum):
     server.stop()
 
 
-async def serve(sbert_model, path, secret, port, host):
+async def serve(sbert_model, path, secret, port, host, derived_key=None, **options):
     """Main method for the server thread."""
 
     loop = asyncio.get_running_loop()
-    server = Server(sbert_model, path, secret, port, host)
+    server = Server(sbert_model, path, secret, port, host, derived_key, **options)
 
     for signum in [signal.SIGTERM, signal.SIGINT]:
         loop.add_signal_handler(signum, partial(stop, server, signum))
@@ -137,7 +684,104 @@ async def serve(sbert_model, path, secret, port, host):
     await server.start()
 
 
-def main(sbert_model, path, host, port):
+def _limit_threads(workers):
+    """Split the cores between the workers, instead of every worker using all of them."""
+    import torch
+
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // workers))
+
+
+def serve_workers(workers, sbert_model, path, secret, port, host, derived_key=None, **options):
+    """Load the model once and fork workers that share it copy-on-write.
+
+    All workers accept on the same port with SO_REUSEPORT and on the unix
+    socket bound before forking. Classifiers trained
+    by one worker are saved to the shared store, the others reload them.
+    Crashed workers are restarted with an exponential backoff.
+    """
+    encoder = _load_encoder(sbert_model)
+    children = {}
+    started = {}
+    delays = dict.fromkeys(range(workers), WORKER_RESTART_DELAY)
+    stopping = False
+
+    def spawn(index):
+        pid = os.fork()
+
+        if pid:
+            children[pid] = index
+            started[index] = time.monotonic()
+            return
+
+        code = 0
+        try:
+            worker_options = dict(options)
+            if worker_options.get("cache_path"):
+                worker_options["cache_path"] = f"{worker_options['cache_path']}.{index}"
+            if worker_options.get("metrics_port"):
+                # Every worker has its own metrics, scraped on its own port.
+                worker_options["metrics_port"] += index
+
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            _limit_threads(workers)
+
+            asyncio.run(
+                serve(
+                    sbert_model,
+                    path,
+                    secret,
+                    port,
+                    host,
+                    derived_key,
+                    encoder=encoder,
+                    reuse_port=True,
+                    **worker_options,
+                )
+            )
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            os._exit(code)
+
+    def forward(signum, _frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    for index in range(workers):
+        spawn(index)
+
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+
+    while children:
+        pid, status = os.wait()
+        index = children.pop(pid, None)
+
+        if index is None or stopping:
+            continue
+
+        if time.monotonic() - started[index] >= WORKER_STABLE_UPTIME:
+            delays[index] = WORKER_RESTART_DELAY
+        LOG.warning(
+            "Worker %d exited with status %d, restarting it in %.0fs", index, status, delays[index]
+        )
+
+        restart = time.monotonic() + delays[index]
+        while not stopping and time.monotonic() < restart:
+            time.sleep(0.1)
+        if not stopping:
+            spawn(index)
+        delays[index] = min(delays[index] * 2, WORKER_RESTART_MAX_DELAY)
+
+
+def main(sbert_model, path, host, port, workers=1):
     print(sbert_model, path, host, port)
     if host is None:
         host = os.environ.get("API_HOST")
@@ -146,7 +790,39 @@ def main(sbert_model, path, host, port):
     if sbert_model is None:
         sbert_model = os.environ.get("SBERT_MODEL")
 
+    options = dict(
+        executor=os.environ.get("API_EXECUTOR", "thread"),
+        executor_workers=int(os.environ.get("API_EXECUTOR_WORKERS", 0)) or 2,
+        batch_window=(int(os.environ.get("API_BATCH_WINDOW_MS", 0)) or 5) / 1000,
+        batch_size=int(os.environ.get("API_BATCH_SIZE", 0)) or 64,
+        token_budget=int(os.environ.get("API_TOKEN_BUDGET", 0)) or TOKEN_BUDGET,
+        cache_size=(int(os.environ.get("API_CACHE_MB", 0)) or 256) << 20,
+        cache_path=os.environ.get("API_CACHE_PATH"),
+        cache_disk_size=(int(os.environ.get("API_CACHE_DISK_MB", 0)) or 1024) << 20,
+        classifier_memory=(int(os.environ.get("API_CLASSIFIER_MB", 0)) or 1024) << 20,
+        model_memory=(int(os.environ.get("API_MODEL_MB", 0)) or 4096) << 20,
+        max_in_flight=int(os.environ.get("API_MAX_IN_FLIGHT", 0)) or 256,
+        queue_timeout=(int(os.environ.get("API_QUEUE_TIMEOUT_MS", 0)) or 30000) / 1000,
+        metrics_port=int(os.environ.get("API_METRICS_PORT", 0)) or None,
+    )
+
+    if socket_path := os.environ.get("API_SOCKET_PATH"):
+        mode = int(os.environ.get("API_SOCKET_MODE") or "660", 8)
+        options["unix_socket"] = bind_unix_socket(socket_path, mode)
+    secret = os.environ.get("API_SECRET")
+    derived_key = os.environ.get("API_DERIVED_KEY")
+
+    # Seconds between checks of the store for classifiers saved elsewhere, workers
+    # always watch it since they share it.
+    options["reload_interval"] = int(os.environ.get("API_RELOAD_INTERVAL", 0))
+
+    if workers > 1:
+        options["reload_interval"] = options["reload_interval"] or 5
+        return serve_workers(
+            workers, sbert_model, path, secret, port, host, derived_key, **options
+        )
+
     return asyncio.run(
-        serve(sbert_model, path, os.environ.get("API_SECRET"), port, host),
+        serve(sbert_model, path, secret, port, host, derived_key, **options),
         debug=os.environ.get("LOG_LEVEL") == "DEBUG",
     )
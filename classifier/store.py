@@ -0,0 +1,417 @@
+"""Persistence of the classifiers of the server, one file per classifier."""
+import fcntl
+import glob
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List
+
+import joblib
+import numpy as np
+
+LOG = logging.getLogger("store")
+
+MANIFEST = "manifest.json"
+LOCK = ".lock"
+
+
+class VersionConflict(Exception):
+    """The classifier was saved again since the version an update started from."""
+
+
+def _write_atomic(path, write) -> None:
+    """Write to a temporary file and rename it over path, so readers never see partial files."""
+    directory = os.path.dirname(path)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            write(fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+@dataclass
+class TrainingSet:
+    """Embedded samples of a classifier, keyed by the sample ids of the client."""
+
+    ids: List = field(default_factory=list)
+    digests: List[str] = field(default_factory=list)
+    labels: List = field(default_factory=list)
+    embeddings: np.ndarray | None = None
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def digest_map(self) -> dict:
+        return dict(zip(self.ids, self.digests))
+
+    def remove(self, ids) -> None:
+        removed = set(ids)
+        keep = [i for i, sample_id in enumerate(self.ids) if sample_id not in removed]
+
+        self.ids = [self.ids[i] for i in keep]
+        self.digests = [self.digests[i] for i in keep]
+        self.labels = [self.labels[i] for i in keep]
+        if self.embeddings is not None:
+            self.embeddings = self.embeddings[keep]
+
+    def add(self, ids, digests, labels, embeddings: np.ndarray) -> None:
+        """Add samples, samples with an existing id are replaced."""
+        self.remove(ids)
+
+        self.ids += list(ids)
+        self.digests += list(digests)
+        self.labels += list(labels)
+        if self.embeddings is None or not len(self.embeddings):
+            self.embeddings = embeddings
+        else:
+            self.embeddings = np.concatenate([self.embeddings, embeddings])
+
+
+class ClassifierStore:
+    """Directory with joblib files per classifier version and a manifest listing the current ones.
+
+    Several processes may share the directory, writes to the manifest are
+    serialized with a file lock and other processes pick them up with refresh.
+    """
+
+    def __init__(self, path) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.manifest_mtime = 0
+
+        os.makedirs(path, exist_ok=True)
+        self.manifest = self._read_manifest()
+
+    def keys(self):
+        return list(self.manifest)
+
+    def __contains__(self, key) -> bool:
+        return key in self.manifest
+
+    def version(self, key) -> int | None:
+        return self.manifest.get(key, {}).get("version")
+
+    def model(self, key) -> str | None:
+        """Name of the sentence model the classifier was trained on, None for the default one."""
+        return self.manifest.get(key, {}).get("model")
+
+    def latest_version(self, key) -> int:
+        """Version of the classifier on disk, 0 if there is none.
+
+        Unlike version it reads the manifest, so saves of other processes
+        count even before refresh picks them up.
+        """
+        return self._latest_manifest().get(key, {}).get("version", 0)
+
+    def refresh(self, force=False) -> bool:
+        """Re-read the manifest if another process changed it, returns whether it changed."""
+        try:
+            mtime = os.stat(os.path.join(self.path, MANIFEST)).st_mtime_ns
+        except FileNotFoundError:
+            return False
+
+        if mtime == self.manifest_mtime and not force:
+            return False
+
+        with self.lock:
+            self.manifest = self._read_manifest()
+        return True
+
+    def load(self, key) -> Any:
+        return self._load(key, "file")
+
+    def load_training_set(self, key) -> TrainingSet | None:
+        if "samples" not in self.manifest.get(key, {}):
+            return None
+        return self._load(key, "samples")
+
+    def _load(self, key, kind) -> Any:
+        try:
+            return joblib.load(os.path.join(self.path, self.manifest[key][kind]))  # nosec
+        except FileNotFoundError:
+            # Removed by a newer save of another process, refresh has not seen it yet.
+            entry = self._latest_manifest()[key]
+            return joblib.load(os.path.join(self.path, entry[kind]))  # nosec
+
+    def save(
+        self,
+        key,
+        classifier,
+        training_set: TrainingSet | None = None,
+        model=None,
+        base_version: int | None = None,
+    ) -> int:
+        """Write the classifier (and its training set) to its own file and add it to the manifest.
+
+        Saves of a key are serialized, across processes too. With base_version
+        VersionConflict is raised if the classifier was saved again since that
+        version, instead of overwriting the newer one. Every version has its
+        own files, the ones of the previous version are kept for processes
+        that still load it. Returns the new version of the classifier.
+        """
+        name = hashlib.sha1(str(key).encode()).hexdigest()
+
+        with open(os.path.join(self.path, f".{name}{LOCK}"), "w") as key_lock:
+            fcntl.flock(key_lock, fcntl.LOCK_EX)
+
+            latest = self.latest_version(key)
+            if base_version is not None and latest != base_version:
+                raise VersionConflict(
+                    f"{key} was saved as version {latest} since version {base_version}"
+                )
+
+            version = latest + 1
+            entry = {"file": f"{name}.{version}.joblib"}
+            if model is not None:
+                entry["model"] = model
+
+            _write_atomic(
+                os.path.join(self.path, entry["file"]),
+                lambda fp: joblib.dump(classifier, fp),
+            )
+
+            if training_set is not None:
+                entry["samples"] = f"{name}.{version}.samples.joblib"
+                _write_atomic(
+                    os.path.join(self.path, entry["samples"]),
+                    lambda fp: joblib.dump(training_set, fp),
+                )
+
+            with self.lock, open(os.path.join(self.path, LOCK), "w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+
+                manifest = self._read_manifest()
+                previous = manifest.get(key, {})
+                self.manifest = {
+                    **manifest,
+                    key: {**entry, "version": version, "saved_at": time.time()},
+                }
+                self._write_manifest()
+
+            keep = {entry.get("file"), entry.get("samples")}
+            keep |= {previous.get("file"), previous.get("samples")}
+            for path in glob.glob(os.path.join(self.path, f"{name}.*joblib")):
+                if os.path.basename(path) not in keep:
+                    os.unlink(path)
+
+        return version
+
+    def _latest_manifest(self) -> Dict[str, dict]:
+        """The manifest on disk, without replacing the one loaded."""
+        try:
+            with open(os.path.join(self.path, MANIFEST)) as fp:
+                return json.load(fp)
+        except FileNotFoundError:
+            return {}
+
+    def _read_manifest(self) -> Dict[str, dict]:
+        path = os.path.join(self.path, MANIFEST)
+        try:
+            with open(path) as fp:
+                self.manifest_mtime = os.fstat(fp.fileno()).st_mtime_ns
+                return json.load(fp)
+        except FileNotFoundError:
+            return {}
+
+    def _write_manifest(self) -> None:
+        data = json.dumps(self.manifest, indent=2).encode()
+        path = os.path.join(self.path, MANIFEST)
+        _write_atomic(path, lambda fp: fp.write(data))
+        self.manifest_mtime = os.stat(path).st_mtime_ns
+
+
+def estimate_size(obj, depth=3) -> int:
+    """Estimate the memory used by a fitted estimator from the arrays it holds."""
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if depth == 0:
+        return 0
+    values: Iterable[Any]
+    if isinstance(obj, dict):
+        values = obj.values()
+    elif isinstance(obj, (list, tuple)):
+        values = obj
+    elif hasattr(obj, "__dict__"):
+        values = vars(obj).values()
+    else:
+        return 0
+    return sum(estimate_size(value, depth - 1) for value in values)
+
+
+class ClassifierCache:
+    """Classifiers loaded from the store on first use, kept in an LRU bounded in bytes.
+
+    Classifiers are only evicted once they are persisted, so they can be
+    loaded again later.
+    """
+
+    def __init__(self, store: ClassifierStore, max_bytes) -> None:
+        self.store = store
+        self.max_bytes = max_bytes
+
+        self.entries: OrderedDict[str, Any] = OrderedDict()
+        self.sizes: Dict[str, int] = {}
+        self.versions: Dict[str, int | None] = {}
+        self.lock = threading.RLock()
+        # Held while a classifier is read from disk, outside of lock.
+        self.loading: Dict[str, threading.Lock] = {}
+
+        self.loads = 0
+        self.evictions = 0
+        self.reloads = 0
+
+    def get(self, key) -> Any | None:
+        """Return the classifier if it is loaded."""
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def load(self, key) -> Any:
+        """Return the classifier, loading it from the store if necessary.
+
+        Concurrent loads of a key read it once, get and put are not blocked
+        while it is read.
+        """
+        classifier = self.get(key)
+        if classifier is not None:
+            return classifier
+
+        with self.lock:
+            loading = self.loading.setdefault(key, threading.Lock())
+
+        try:
+            with loading:
+                classifier = self.get(key)
+                if classifier is not None:
+                    return classifier
+
+                if key not in self.store:
+                    # Possibly trained by another process since the manifest was read.
+                    self.store.refresh()
+                    if key not in self.store:
+                        raise KeyError(key)
+                version = self.store.version(key)
+                classifier = self.store.load(key)
+
+                with self.lock:
+                    self.loads += 1
+                    self.put(key, classifier, version)
+                return classifier
+        finally:
+            with self.lock:
+                if self.loading.get(key) is loading:
+                    del self.loading[key]
+
+    def put(self, key, classifier, version=None) -> None:
+        """Replace the classifier, users of the old one keep their reference.
+
+        A classifier older than the loaded version is ignored.
+        """
+        with self.lock:
+            current = self.versions.get(key)
+            if version is not None and current is not None and version < current:
+                return
+
+            self.entries[key] = classifier
+            self.entries.move_to_end(key)
+            self.sizes[key] = estimate_size(classifier)
+            self.versions[key] = version
+            self._evict()
+
+    def refresh(self, force=False) -> List[str]:
+        """Swap in classifiers that were saved again by another process, returns their keys.
+
+        The new version is loaded before it replaces the old one, predictions
+        in flight finish on the old one. If the new version can't be loaded
+        the old one stays.
+        """
+        if not self.store.refresh(force):
+            return []
+
+        with self.lock:
+            stale = [
+                (key, self.store.version(key))
+                for key in self.entries
+                if key in self.store and self.versions[key] != self.store.version(key)
+            ]
+
+        reloaded = []
+        for key, version in stale:
+            try:
+                classifier = self.store.load(key)
+            except Exception:
+                LOG.exception("Could not load version %s of %s, keeping the old one", version, key)
+                continue
+
+            with self.lock:
+                # Skip it if it was evicted or replaced by a newer version meanwhile.
+                if key in self.entries and self.store.version(key) == version:
+                    self.put(key, classifier, version)
+                    self.reloads += 1
+                    reloaded.append(key)
+
+        return reloaded
+
+    @property
+    def size(self) -> int:
+        return sum(self.sizes.values())
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "resident": len(self.entries),
+                "bytes": self.size,
+                "stored": len(self.store.keys()),
+                "loads": self.loads,
+                "evictions": self.evictions,
+                "reloads": self.reloads,
+            }
+
+    def _evict(self) -> None:
+        # The most recently used classifier always stays.
+        for key in list(self.entries)[:-1]:
+            if self.size <= self.max_bytes:
+                break
+            if key not in self.store:
+                continue
+            self._drop(key)
+            self.evictions += 1
+
+    def _drop(self, key) -> None:
+        del self.entries[key]
+        del self.sizes[key]
+        del self.versions[key]
+
+
+def open_store(path) -> ClassifierStore:
+    """Open the store at path, a single file dump of older versions is imported first."""
+    if not os.path.isfile(path):
+        return ClassifierStore(path)
+
+    store = ClassifierStore(f"{path}.d")
+
+    for key, classifier in joblib.load(path).items():  # nosec
+        if key not in store:
+            store.save(key, classifier)
+
+    return store
@@ -1,7 +1,58 @@
+import asyncio
+import os
+import socket
+import tempfile
+import threading
+import time
+from multiprocessing import shared_memory
+from typing import List
+from uuid import uuid4
+
+import numpy as np
+from cryptography.fernet import InvalidToken
 from django.test import TestCase
+from document_embedding.pert import PertDocumentEmbedding
+from sklearn.dummy import DummyClassifier
+from sklearn.neighbors import KNeighborsClassifier
 
-from classifier.classify import train_classifier
+from classifier import benchmark
+from classifier.cache import EmbeddingCache
+from classifier.classify import (
+    _subset_sizes,
+    export_classifier,
+    find_classifier,
+    train_classifier,
+)
+from classifier.client import AsyncClient, Client, ClientPool, HashRing
+from classifier.connection import (
+    OVERLOADED,
+    PROTOCOL_FRAMES,
+    PROTOCOL_LOCAL,
+    PROTOCOL_SHARED_MEMORY,
+    PROTOCOLS,
+    Command,
+    Overloaded,
+    Recorder,
+    Result,
+    ServerException,
+    compact_embeddings,
+    expand_embeddings,
+    gen_key,
+    pack_frame,
+    read_recording,
+    receive_command,
+    receive_obj_sync,
+    send_obj_sync,
+    send_result,
+    unpack_obj,
+)
+from classifier.encoding import Padding, encode_sentences
+from classifier.jobs import JobQueue, SharedJobs
+from classifier.metrics import Metrics
 from classifier.models import Classifier, Sample
+from classifier.replay import replay
+from classifier.server import Server
+from classifier.store import ClassifierCache, ClassifierStore, TrainingSet, VersionConflict
 
 # Create your tests here.
 
@@ -41,3 +92,575 @@ class ClassifierTestCase(TestCase):
         Sample.objects.bulk_create(samples)
 
         train_classifier(model)
+
+    def test_find_classifier(self):
+        rng = np.random.default_rng(0)
+        y = np.repeat([0, 1, 2], 30)
+        X = rng.normal(y[:, None] * 5, 1, (len(y), 8))
+
+        # The best candidate wins, not the last one.
+        classifier = find_classifier(X, y, [KNeighborsClassifier(), DummyClassifier()], n_jobs=1)
+
+        self.assertIsInstance(classifier, KNeighborsClassifier)
+        self.assertEqual(classifier.predict(X[:1]).tolist(), [0])
+
+    def test_halving_schedule(self):
+        rng = np.random.default_rng(0)
+        y = np.repeat([0, 1, 2], 1000)
+        X = rng.normal(y[:, None], 1, (len(y), 8))
+        fits = []
+
+        class Candidate(KNeighborsClassifier):
+            def fit(self, X, y):
+                fits.append((self.n_neighbors, len(X)))
+                return super().fit(X, y)
+
+        self.assertEqual(_subset_sizes(y, 5, 5, 3), [1000, 3000])
+
+        find_classifier(X, y, [Candidate(n_neighbors=k) for k in range(1, 6)], n_jobs=1)
+
+        # The folds of the last round train on 4/5 of all samples.
+        finalists = {k for k, size in fits if size == 2400}
+        self.assertGreaterEqual(len(finalists), 2)
+
+    def test_export_classifier(self):
+        encoder = PertDocumentEmbedding(WordCountModel())
+
+        with tempfile.TemporaryDirectory() as directory:
+            version = export_classifier(
+                directory,
+                "topics",
+                self.sentences,
+                self.labels,
+                candidates=[KNeighborsClassifier(), DummyClassifier()],
+                encoder=encoder,
+            )
+            store = ClassifierStore(directory)
+            classifier = store.load("topics")
+            training_set = store.load_training_set("topics")
+
+        # Embedded like the server embeds, with the width of the encoder.
+        width = encoder.encode(self.sentences[0]).shape[-1]
+
+        self.assertEqual(version, 1)
+        self.assertEqual(classifier.n_features_in_, width)
+        assert training_set is not None and training_set.embeddings is not None
+        self.assertEqual(training_set.embeddings.shape, (15, width))
+        self.assertEqual(training_set.labels, self.labels)
+
+
+class ConnectionTestCase(TestCase):
+    def setUp(self):
+        self.key = gen_key("secret")
+        self.writer, self.reader = socket.socketpair()
+
+    def tearDown(self):
+        self.writer.close()
+        self.reader.close()
+
+    def roundtrip(self, obj, protocol):
+        send_obj_sync(self.writer, obj, self.key, protocol)
+        return receive_obj_sync(self.reader, self.key)
+
+    def test_array_result(self):
+        embeddings = np.random.rand(16, 384).astype(np.float32)
+
+        for protocol in PROTOCOLS:
+            result = self.roundtrip(Result(embeddings, uuid4()), protocol)
+
+            self.assertEqual(result.payload.dtype, np.float32)
+            self.assertTrue(result.payload.flags.writeable)
+            np.testing.assert_array_equal(result.payload, embeddings)
+
+    def test_local_frames(self):
+        embeddings = np.random.rand(1024, 384).astype(np.float32)
+
+        for protocol in (PROTOCOL_SHARED_MEMORY, PROTOCOL_LOCAL):
+            # Larger than the socket buffer, it is sent while it is received.
+            sender = threading.Thread(
+                target=send_obj_sync,
+                args=(self.writer, Result(embeddings, uuid4()), None, protocol),
+            )
+            sender.start()
+            shared = protocol == PROTOCOL_SHARED_MEMORY
+            result = receive_obj_sync(self.reader, None, local=True, shared_memory=shared)
+            sender.join()
+
+            self.assertTrue(result.payload.flags.writeable)
+            np.testing.assert_array_equal(result.payload, embeddings)
+
+        # Shared memory of a frame that could not be sent is removed.
+        blocks = set(os.listdir("/dev/shm"))
+        closed, _ = socket.socketpair()
+        closed.close()
+        with self.assertRaises(OSError):
+            send_obj_sync(closed, Result(embeddings, uuid4()), None, PROTOCOL_SHARED_MEMORY)
+        self.assertEqual(set(os.listdir("/dev/shm")), blocks)
+
+        # Unencrypted frames are refused outside of unix sockets.
+        send_obj_sync(self.writer, Result("hello", uuid4()), None, PROTOCOL_LOCAL)
+        with self.assertRaises(InvalidToken):
+            receive_obj_sync(self.reader, self.key)
+
+        # Shared memory is refused unless it was negotiated, and left alone.
+        for secret in (None, self.key):
+            names: List[str] = []
+            frame = pack_frame(Result(embeddings, uuid4()), secret, names)
+            try:
+                with self.assertRaises(ValueError):
+                    unpack_obj(b"".join(frame[1:]), secret, local=True)
+                self.assertTrue(set(names) <= set(os.listdir("/dev/shm")))
+            finally:
+                for name in names:
+                    shared_memory.SharedMemory(name=name).unlink()
+
+    def test_int8_embeddings(self):
+        embeddings = np.random.randn(16, 384).astype(np.float32)
+
+        result = self.roundtrip(Result(compact_embeddings(embeddings, "int8"), uuid4()), PROTOCOL_FRAMES)
+        codes, scales = result.payload
+
+        self.assertEqual(codes.dtype, np.int8)
+        self.assertEqual(scales.shape, (16, 1))
+        np.testing.assert_allclose(expand_embeddings(result.payload), embeddings, atol=scales.max())
+
+    def test_command_fallback(self):
+        cmd = Command("predict", uuid4(), {"key": "inbox", "sentences": ["Hello"]})
+
+        for protocol in PROTOCOLS:
+            self.assertEqual(self.roundtrip(cmd, protocol), cmd)
+
+    def test_out_of_order_results(self):
+        client = Client("localhost", 0, "secret")
+        client.socket = self.reader
+        first, second = uuid4(), uuid4()
+
+        send_obj_sync(self.writer, Result("second", second), self.key)
+        send_obj_sync(self.writer, Result("first", first), self.key)
+
+        self.assertEqual(client.wait(first).payload, "first")
+        self.assertEqual(client.wait(second).payload, "second")
+
+    def test_pool_drops_desynced_client(self):
+        pool = ClientPool("localhost", 0, "secret")
+        client = Client("localhost", 0, "secret")
+        client.socket, client.connected = self.reader, True
+        pool.idle.append((client, time.monotonic()))
+
+        with self.assertRaises(InvalidToken):
+            with pool.connection() as pooled:
+                raise InvalidToken
+
+        self.assertIs(pooled, client)
+        self.assertFalse(client.connected)
+        self.assertEqual(pool.idle, [])
+
+    def test_overloaded(self):
+        client = Client("localhost", 0, "secret")
+        client.socket = self.reader
+        uuid = uuid4()
+
+        send_obj_sync(self.writer, ServerException("Overloaded", uuid, OVERLOADED), self.key)
+
+        with self.assertRaises(Overloaded):
+            client.wait(uuid)
+
+
+class AsyncClientTestCase(TestCase):
+    """AsyncClient against a server that answers the commands it collected in reverse order."""
+
+    def run_client(self, test, commands_per_reply=1, reply=True):
+        key = gen_key("secret")
+
+        async def handle(reader, writer):
+            cmd = await receive_command(reader, key)
+            await send_result(writer, Result({"protocol": PROTOCOL_FRAMES}, cmd.uuid), key)
+
+            received = [await receive_command(reader, key) for _ in range(commands_per_reply)]
+            for cmd in reversed(received):
+                if reply:
+                    await send_result(writer, Result(cmd.payload, cmd.uuid), key, PROTOCOL_FRAMES)
+            writer.close()
+
+        async def main():
+            server = await asyncio.start_server(handle, "127.0.0.1", 0)
+            client = AsyncClient("127.0.0.1", server.sockets[0].getsockname()[1], "secret")
+            await client.connect()
+            try:
+                return await asyncio.wait_for(test(client), 10)
+            finally:
+                server.close()
+
+        return asyncio.run(main())
+
+    def test_concurrent_commands(self):
+        async def test(client):
+            return await asyncio.gather(
+                *(client.send_command(Command("echo", uuid4(), i)) for i in range(3))
+            )
+
+        results = self.run_client(test, commands_per_reply=3)
+
+        # Results arrive in reverse order, the reader task routes them by uuid.
+        self.assertEqual([result.payload for result in results], [0, 1, 2])
+
+    def test_server_disconnect(self):
+        async def test(client):
+            with self.assertRaises(ConnectionResetError):
+                await client.send_command(Command("echo", uuid4(), 1))
+            with self.assertRaises(ConnectionResetError):
+                await client.send_command(Command("echo", uuid4(), 2))
+
+        self.run_client(test, reply=False)
+
+
+class RecorderTestCase(TestCase):
+    def test_read_recording(self):
+        commands = [
+            Command("embedding", uuid4(), {"sentence": ["Hello"]}),
+            Command("predict", uuid4(), {"key": "inbox", "sentences": ["Hello"]}),
+        ]
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "commands.rec")
+            recorder = Recorder(path)
+            for cmd in commands:
+                recorder.record(cmd)
+            recorder.close()
+
+            # A recorder stopped while writing leaves a truncated record.
+            with open(path, "ab") as fp:
+                fp.write((1000).to_bytes(8, "big") + b"partial")
+
+            recorded = list(read_recording(path))
+
+        self.assertEqual([cmd for _, cmd in recorded], commands)
+        self.assertLessEqual(recorded[0][0], recorded[1][0])
+
+    def test_replay_skips_writes(self):
+        class Client:
+            sent = []
+
+            async def send_command(self, cmd):
+                self.sent.append(cmd.name)
+
+        commands = [
+            (0.0, Command(name, uuid4(), {}))
+            for name in ["connect", "training_set", "train", "predict", "close"]
+        ]
+
+        report = asyncio.run(replay(commands, Client(), speed=0, allow_writes=False))
+
+        self.assertEqual(Client.sent, ["predict"])
+        self.assertEqual(report.stats()["skipped"], {"training_set": 1, "train": 1})
+
+
+class HashRingTestCase(TestCase):
+    def test_added_node_takes_over_keys(self):
+        before = HashRing(["a:1", "b:1", "c:1"])
+        after = HashRing(["a:1", "b:1", "c:1", "d:1"])
+        keys = [f"inbox-{i}" for i in range(1000)]
+
+        moved = [key for key in keys if before.node(key) != after.node(key)]
+
+        self.assertTrue(all(after.node(key) == "d:1" for key in moved))
+        self.assertLess(len(moved), len(keys) / 2)
+
+
+class EmbeddingCacheTestCase(TestCase):
+    def test_spill_to_disk(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "embeddings")
+            cache = EmbeddingCache(2 * 384 * 4, path)
+
+            for i in range(4):
+                cache.put(f"text {i}", np.full(384, i, dtype=np.float32))
+
+            self.assertEqual(cache.stats()["entries"], 2)
+            np.testing.assert_array_equal(cache.get("text 0"), np.zeros(384))
+            self.assertEqual(cache.stats()["disk_hits"], 1)
+            cache.close()
+
+            cache = EmbeddingCache(2 * 384 * 4, path)
+            np.testing.assert_array_equal(cache.get("text 3"), np.full(384, 3))
+            self.assertIsNone(cache.get("text 4"))
+            cache.close()
+
+    def test_keyed_by_model(self):
+        cache = EmbeddingCache(1 << 20)
+        cache.put("text", np.zeros(384, dtype=np.float32), "small")
+
+        self.assertIsNotNone(cache.get("text", "small"))
+        self.assertIsNone(cache.get("text", "large"))
+        self.assertIsNone(cache.get("text"))
+
+
+class WordCountModel:
+    """Sentence model that embeds a sentence as its number of words."""
+
+    max_seq_length = 128
+
+    def __init__(self) -> None:
+        self.batch_sizes = []
+
+    def tokenizer(self, sentences, **kwargs):
+        return {"input_ids": [sentence.split() for sentence in sentences]}
+
+    def encode(self, sentences, batch_size=32):
+        self.batch_sizes.append(len(sentences))
+        return np.array([[len(sentence.split())] for sentence in sentences])
+
+    def parameters(self):
+        return []
+
+
+class EncodingTestCase(TestCase):
+    def test_length_buckets(self):
+        model = WordCountModel()
+        sentences = ["word " * n for n in [1, 40, 2, 40, 3]]
+        padding = Padding()
+
+        embeddings = encode_sentences(model, sentences, 80, padding)
+
+        self.assertEqual(embeddings[:, 0].tolist(), [1, 40, 2, 40, 3])
+        self.assertEqual(model.batch_sizes, [3, 2])
+        self.assertEqual(padding.stats()["padded_tokens"], 3 * 3 + 2 * 40)
+
+    def test_embedding_shape(self):
+        encoder = PertDocumentEmbedding(WordCountModel())
+        documents = ["One word. And three words.", "Two words."]
+
+        with tempfile.TemporaryDirectory() as directory:
+            server = Server("words", directory, "secret", encoder=encoder)
+
+            async def embed():
+                return [await server.get_embedding(d) for d in [documents[0], documents]]
+
+            single, batch = asyncio.run(embed())
+            server.executor.shutdown()
+            server.train_executor.shutdown()
+
+        # A single string keeps the shape the encoder returns for it.
+        self.assertEqual(single.shape, encoder.encode(documents[0]).shape)
+        self.assertEqual(batch.tolist(), encoder.encode(documents).tolist())
+
+
+class MetricsTestCase(TestCase):
+    def test_prometheus_text(self):
+        metrics = Metrics()
+        metrics.increment("commands_total", command="predict", status="ok")
+        metrics.observe("phase_seconds", 0.003, phase="encode")
+        metrics.observe("phase_seconds", 20, phase="encode")
+
+        text = metrics.render()
+
+        self.assertIn('classifier_commands_total{command="predict",status="ok"} 1', text)
+        self.assertIn('classifier_phase_seconds_bucket{phase="encode",le="0.005"} 1', text)
+        self.assertIn('classifier_phase_seconds_bucket{phase="encode",le="+Inf"} 2', text)
+        self.assertIn('classifier_phase_seconds_count{phase="encode"} 2', text)
+
+
+class ClassifierStoreTestCase(TestCase):
+    def test_save_and_reopen(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = ClassifierStore(directory)
+            store.save("inbox", {"labels": [1, 2]})
+            store.save("other", {"labels": [3]})
+            store.save("inbox", {"labels": [1, 2, 4]})
+
+            store = ClassifierStore(directory)
+
+            self.assertEqual(sorted(store.keys()), ["inbox", "other"])
+            self.assertEqual(store.load("inbox"), {"labels": [1, 2, 4]})
+            self.assertEqual(store.manifest["inbox"]["version"], 2)
+
+            # A process that has not seen version 3 yet still loads version 2,
+            # version 1 is removed.
+            ClassifierStore(directory).save("inbox", {"labels": [1]})
+            name = store.manifest["inbox"]["file"].split(".")[0]
+            files = sorted(f for f in os.listdir(directory) if f.startswith(name))
+            self.assertEqual(files, [f"{name}.2.joblib", f"{name}.3.joblib"])
+            self.assertEqual(store.load("inbox"), {"labels": [1, 2, 4]})
+
+    def test_save_conflict(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = ClassifierStore(directory)
+            base = store.latest_version("inbox")
+            ClassifierStore(directory).save("inbox", {"labels": [1, 2]})
+
+            with self.assertRaises(VersionConflict):
+                store.save("inbox", {"labels": [1]}, base_version=base)
+
+            self.assertEqual(store.save("inbox", {"labels": [1]}, base_version=1), 2)
+
+            cache = ClassifierCache(store, 1 << 20)
+            cache.put("inbox", {"labels": [1]}, 2)
+            cache.put("inbox", {"labels": [1, 2]}, 1)
+            self.assertEqual(cache.get("inbox"), {"labels": [1]})
+
+    def test_load_outside_lock(self):
+        started, release = threading.Event(), threading.Event()
+
+        class SlowStore(ClassifierStore):
+            reads = 0
+
+            def load(self, key):
+                self.reads += 1
+                started.set()
+                release.wait(5)
+                return super().load(key)
+
+        with tempfile.TemporaryDirectory() as directory:
+            store = SlowStore(directory)
+            store.save("inbox", {"labels": [1]})
+            cache = ClassifierCache(store, 1 << 20)
+            loads = [threading.Thread(target=cache.load, args=("inbox",)) for _ in range(2)]
+            for thread in loads:
+                thread.start()
+
+            started.wait(5)
+            # Not blocked by the load in progress.
+            put = threading.Thread(target=cache.put, args=("other", {"labels": [2]}))
+            put.start()
+            put.join(1)
+            self.assertFalse(put.is_alive())
+
+            release.set()
+            for thread in loads:
+                thread.join()
+
+            self.assertEqual(store.reads, 1)
+            self.assertEqual(cache.get("inbox"), {"labels": [1]})
+
+    def test_reload_swaps_classifier(self):
+        with tempfile.TemporaryDirectory() as directory:
+            ClassifierStore(directory).save("inbox", {"labels": [1]})
+            cache = ClassifierCache(ClassifierStore(directory), 1 << 20)
+            old = cache.load("inbox")
+
+            ClassifierStore(directory).save("inbox", {"labels": [1, 2]})
+
+            self.assertEqual(cache.refresh(force=True), ["inbox"])
+            self.assertEqual(cache.get("inbox"), {"labels": [1, 2]})
+            self.assertEqual(old, {"labels": [1]})
+
+    def test_load_saved_by_other_process(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = ClassifierCache(ClassifierStore(directory), 1 << 20)
+            ClassifierStore(directory).save("inbox", {"labels": [1]})
+
+            self.assertEqual(cache.load("inbox"), {"labels": [1]})
+            with self.assertRaises(KeyError):
+                cache.load("outbox")
+
+    def test_remove_all_samples(self):
+        with tempfile.TemporaryDirectory() as directory:
+            encoder = PertDocumentEmbedding(WordCountModel())
+            server = Server("words", directory, "secret", encoder=encoder)
+
+            async def train(*args):
+                job = server.train_classifier("inbox", *args)
+                while not job.done:
+                    await asyncio.sleep(0.01)
+                return job
+
+            async def main():
+                trained = await train(["One.", "Two words.", "Three words here."], [0, 1, 1])
+                emptied = await train([], [], None, [0, 1, 2])
+                return trained, emptied, await server.load_training_set("inbox")
+
+            trained, emptied, training_set = asyncio.run(main())
+            server.executor.shutdown()
+            server.train_executor.shutdown()
+
+        self.assertIsNone(trained.error)
+        self.assertIn("No samples left to train inbox", emptied.error)
+        self.assertEqual(len(training_set), 3)
+
+    def test_training_set_update(self):
+        training_set = TrainingSet()
+        training_set.add([1, 2, 3], ["a", "b", "c"], [0, 0, 1], np.eye(3))
+
+        training_set.remove([2])
+        training_set.add([3, 4], ["c2", "d"], [1, 1], np.ones((2, 3)))
+
+        self.assertEqual(training_set.ids, [1, 3, 4])
+        self.assertEqual(training_set.digest_map(), {1: "a", 3: "c2", 4: "d"})
+        np.testing.assert_array_equal(training_set.embeddings[0], [1, 0, 0])
+        np.testing.assert_array_equal(training_set.embeddings[1], [1, 1, 1])
+
+
+class SharedJobsTestCase(TestCase):
+    def test_status_and_cancel_through_other_worker(self):
+        async def run(job):
+            while True:
+                job.check_cancelled()
+                await asyncio.sleep(0.01)
+
+        async def main(directory):
+            worker = JobQueue(run, SharedJobs(directory))
+            other = JobQueue(run, SharedJobs(directory))
+            job = worker.submit("inbox", {}, 10)
+            await asyncio.sleep(0.05)
+
+            running = other.status(job.id)
+            other.cancel(job.id)
+            while not job.done:
+                await asyncio.sleep(0.05)
+            return running, other.status(job.id)
+
+        with tempfile.TemporaryDirectory() as directory:
+            running, cancelled = asyncio.run(asyncio.wait_for(main(directory), 5))
+
+            with self.assertRaises(KeyError):
+                JobQueue(run, SharedJobs(directory)).status("unknown")
+
+        self.assertEqual(running["phase"], "queued")
+        self.assertEqual(cancelled["phase"], "cancelled")
+
+
+class AdmissionTestCase(TestCase):
+    def test_timeout_only_while_waiting(self):
+        class SlowServer(Server):
+            async def process_command(self, cmd, local=False):
+                await asyncio.sleep(0.2)
+                return Result(cmd.payload, cmd.uuid)
+
+        with tempfile.TemporaryDirectory() as directory:
+            encoder = PertDocumentEmbedding(WordCountModel())
+            server = SlowServer(
+                "words", directory, "secret", encoder=encoder, max_in_flight=1, queue_timeout=0.05
+            )
+
+            async def main():
+                return await asyncio.gather(
+                    *(server.admit(Command("embedding", uuid4(), i)) for i in range(3))
+                )
+
+            admitted, dropped, rejected = asyncio.run(main())
+            server.executor.shutdown()
+            server.train_executor.shutdown()
+
+        # Runs longer than the queue timeout, but it was admitted straight away.
+        self.assertEqual(admitted.payload, 0)
+        self.assertEqual((dropped.code, dropped.error), (OVERLOADED, "Overloaded: deadline exceeded"))
+        self.assertEqual(rejected.error, "Overloaded: too many commands waiting")
+
+
+class BenchmarkTestCase(TestCase):
+    def test_regressions(self):
+        results = benchmark.run(["pack"], ["short_string"], repeat=1)
+        baseline = benchmark.report(results)
+
+        self.assertEqual(
+            [result["name"] for result in baseline["results"]],
+            [f"pack/short_string/{protocol}" for protocol in benchmark.PACK_PROTOCOLS],
+        )
+        self.assertEqual(benchmark.regressions(baseline, baseline), [])
+
+        slower = benchmark.report(results)
+        slower["results"][0] = {**slower["results"][0], "seconds": results[0].seconds * 2}
+        self.assertEqual(
+            benchmark.regressions(baseline, slower),
+            [{"name": "pack/short_string/1", "ratio": 2.0}],
+        )
@@ -2,23 +2,28 @@ from typing import Iterable, List
 
 from django.conf import settings
 
-from classifier.client import Client
+from classifier.client import get_cluster
 
 
 class EmbeddingModel:
-    def __init__(self, language) -> None:
-        self.client = Client(settings.API_HOST, settings.API_HOST, settings.API_SECRET)
-        self.client.connect()
+    def __init__(self, model_name, language) -> None:
+        # Embeddings are balanced over all servers.
+        self.cluster = get_cluster(
+            settings.API_ENDPOINTS, settings.API_SECRET, settings.API_DERIVED_KEY
+        )
+        self.model_name = model_name
         self.language = language
 
     def get_embedding(self, sentence):
-        return self.client.get_embedding(sentence)
+        return self.cluster.get_embedding(sentence, self.model_name)
 
     def batch_get_embeddings(self, sentences: List[str]):
-        return self.client.get_embedding(sentences)
+        return self.cluster.get_embedding(sentences, self.model_name)
 
     def get_document_embeddings(self, document: str):
         return self.get_embedding(document)
 
     def batch_get_document_embeddings(self, documents: Iterable[str]):
-        return self.client.get_embedding(documents)
+        """Yields the embedding of each document, they are streamed from the server in chunks."""
+        for embeddings in self.cluster.stream_embeddings(documents, self.model_name):
+            yield from embeddings
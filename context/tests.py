@@ -24,12 +24,17 @@ class TestVectorStore(TestCase):
 
     def test_create_embeddings(self):
         model = EmbeddingModel("paraphrase-multilingual-MiniLM-L12-v2", "german")
-        model.batch_get_document_embeddings(
-            [
-                "This is my first test",
-                "This is the second test, and so on. But this has two sentences.",
-            ]
+        embeddings = list(
+            model.batch_get_document_embeddings(
+                [
+                    "This is my first test",
+                    "This is the second test, and so on. But this has two sentences.",
+                ]
+            )
         )
+        assert len(embeddings) == 2
+        assert embeddings[0].ndim == 1
+        assert embeddings[0].shape == embeddings[1].shape
 
     def test_simple_site(self):
         process = CrawlerProcess(
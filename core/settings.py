@@ -185,8 +185,18 @@ CELERY_CACHE_BACKEND = "django-cache"
 
 API_HOST = env("API_HOST", default="ml_api")
 API_PORT = env.int("API_PORT", default=8081)
-API_PATH = env("API_PATH", default="/store/data.db")
+# Directory of the classifiers, a single file dump of older versions is imported
+API_PATH = env("API_PATH", default="/store/classifiers")
 API_SECRET = env("API_SECRET", default="secret")
+# Output of `manage.py derivekey`, skips the key derivation when set
+API_DERIVED_KEY = env("API_DERIVED_KEY", default="")
+# Unix socket of a server on the same host, used instead of API_HOST and API_PORT when set
+API_SOCKET_PATH = env("API_SOCKET_PATH", default="")
+# Several servers as host:port (or unix:path), classifiers are sharded across them
+API_HOSTS = env.list("API_HOSTS", default=[])
+API_ENDPOINTS = API_HOSTS or [
+    f"unix:{API_SOCKET_PATH}" if API_SOCKET_PATH else f"{API_HOST}:{API_PORT}"
+]
 SBERT_MODEL = env("SBERT_MODEL", default="paraphrase-multilingual-MiniLM-L12-v2")
 
 CRAWL_DIR = BASE_DIR / "crawls"